@@ -141,7 +141,8 @@ class FastSpeech2(torch.nn.Module, ABC):
                                n_filts=postnet_filts,
                                use_batch_norm=use_batch_norm,
                                dropout_rate=postnet_dropout_rate)
-        self.load_state_dict(weights)
+        if weights is not None:
+            self.load_state_dict(weights)
 
     def _forward(self, text_tensors, text_lens, gold_speech=None, speech_lens=None,
                  gold_durations=None, gold_pitch=None, gold_energy=None,
@@ -187,6 +188,9 @@ class FastSpeech2(torch.nn.Module, ABC):
             energy_embeddings = self.energy_embed(energy_predictions.transpose(1, 2)).transpose(1, 2)
             encoded_texts = encoded_texts + energy_embeddings + pitch_embeddings
             encoded_texts = self.length_regulator(encoded_texts, duration_predictions, alpha)
+            if text_tensors.size(0) > 1:
+                # in a padded batch the decoder needs to know where each spectrogram ends
+                speech_lens = self._regulated_lengths(duration_predictions, alpha)
         else:
             duration_predictions = self.duration_predictor(encoded_texts, duration_masks)
 
@@ -197,7 +201,7 @@ class FastSpeech2(torch.nn.Module, ABC):
             encoded_texts = self.length_regulator(encoded_texts, gold_durations)  # (B, Lmax, adim)
 
         # forward decoder
-        if speech_lens is not None and not is_inference:
+        if speech_lens is not None:
             if self.reduction_factor > 1:
                 olens_in = speech_lens.new([olen // self.reduction_factor for olen in speech_lens])
             else:
@@ -209,7 +213,7 @@ class FastSpeech2(torch.nn.Module, ABC):
         before_outs = self.feat_out(zs).view(zs.size(0), -1, self.odim)  # (B, Lmax, odim)
 
         # postnet -> (B, Lmax//r * r, odim)
-        after_outs = before_outs + self.postnet(before_outs.transpose(1, 2)).transpose(1, 2)
+        after_outs = before_outs + self.postnet(before_outs.transpose(1, 2), h_masks).transpose(1, 2)
 
         return before_outs, after_outs, duration_predictions, pitch_predictions, energy_predictions
 
@@ -269,6 +273,58 @@ class FastSpeech2(torch.nn.Module, ABC):
             return after_outs[0], d_outs[0], pitch_predictions[0], energy_predictions[0]
         return after_outs[0]
 
+    @torch.no_grad()
+    def batch_forward(self,
+                      text_tensors,
+                      text_lengths,
+                      utterance_embedding=None,
+                      lang_ids=None,
+                      durations=None,
+                      pitch=None,
+                      energy=None):
+        """
+        Generate several spectrograms at once from a padded batch of phoneme sequences.
+
+        Args:
+            text_tensors: Padded batch of articulatory feature sequences (B, Tmax, idim)
+            text_lengths: Amount of phones in each sequence (B,)
+            utterance_embedding: embedding of utterance wide parameters, either one for the whole batch or one per sequence
+            lang_ids: language ID for each sequence (B,)
+            durations: padded batch of groundtruth durations (B, Tmax)
+            pitch: padded batch of groundtruth token-averaged pitch (B, Tmax, 1)
+            energy: padded batch of groundtruth token-averaged energy (B, Tmax, 1)
+
+        Returns:
+            padded Mel Spectrograms (B, Lmax, odim), amount of frames in each of them (B,), durations, pitch and energy
+
+        """
+        self.eval()
+        device = text_tensors.device
+        text_lengths = text_lengths.to(device)
+        if utterance_embedding is not None and utterance_embedding.dim() == 1:
+            utterance_embedding = utterance_embedding.unsqueeze(0).expand(text_tensors.size(0), -1)
+        if lang_ids is not None:
+            lang_ids = lang_ids.view(-1, 1).to(device)
+        before_outs, after_outs, d_outs, pitch_predictions, energy_predictions = self._forward(text_tensors,
+                                                                                               text_lengths,
+                                                                                               gold_durations=durations,
+                                                                                               is_inference=True,
+                                                                                               gold_pitch=pitch,
+                                                                                               gold_energy=energy,
+                                                                                               utterance_embedding=utterance_embedding,
+                                                                                               lang_ids=lang_ids)
+        self.train()
+        return after_outs, self._regulated_lengths(d_outs, self.alpha if self.alpha else 1.0), d_outs, pitch_predictions, energy_predictions
+
+    @staticmethod
+    def _regulated_lengths(durations, alpha):
+        """
+        Amount of frames the LengthRegulator produces for each sequence in the batch
+        """
+        if alpha != 1.0:
+            durations = torch.round(durations.float() * alpha).long()
+        return durations.sum(dim=1)
+
     def _source_mask(self, ilens):
         x_masks = make_non_pad_mask(ilens).to(next(self.parameters()).device)
         return x_masks.unsqueeze(-2)
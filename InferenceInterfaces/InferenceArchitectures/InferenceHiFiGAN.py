@@ -6,7 +6,7 @@ from Layers.ResidualBlock import HiFiGANResidualBlock as ResidualBlock
 class HiFiGANGenerator(torch.nn.Module):
 
     def __init__(self,
-                 path_to_weights,
+                 path_to_weights=None,
                  in_channels=80,
                  out_channels=1,
                  channels=512,
@@ -19,12 +19,22 @@ class HiFiGANGenerator(torch.nn.Module):
                  bias=True,
                  nonlinear_activation="LeakyReLU",
                  nonlinear_activation_params={"negative_slope": 0.1},
-                 use_weight_norm=True, ):
+                 use_weight_norm=True,
+                 weights=None):
+        """
+        Either loads a checkpoint from path_to_weights or takes
+        the weights of a generator whose weight norm has already
+        been removed, like the ones in an inference bundle. With
+        neither, the generator keeps its random initialization.
+        """
         super().__init__()
         assert kernel_size % 2 == 1, "Kernal size must be odd number."
         assert len(upsample_scales) == len(upsample_kernel_sizes)
         assert len(resblock_dilations) == len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_kernel_sizes)
+        self.upsample_factor = 1
+        for upsample_scale in upsample_scales:
+            self.upsample_factor *= upsample_scale  # amount of samples produced per spectrogram frame
         self.num_blocks = len(resblock_kernel_sizes)
         self.input_conv = torch.nn.Conv1d(in_channels,
                                           channels,
@@ -57,14 +67,25 @@ class HiFiGANGenerator(torch.nn.Module):
                             1,
                             padding=(kernel_size - 1) // 2, ),
             torch.nn.Tanh(), )
-        if use_weight_norm:
-            self.apply_weight_norm()
-        self.load_state_dict(torch.load(path_to_weights, map_location='cpu')["generator"])
+        if weights is not None:
+            self.load_state_dict(weights)
+        elif path_to_weights is not None:
+            if use_weight_norm:
+                self.apply_weight_norm()
+            self.load_state_dict(torch.load(path_to_weights, map_location='cpu')["generator"])
+            # weight norm only matters for training, so we fold it into the plain weights once
+            self.remove_weight_norm()
 
     def forward(self, c, normalize_before=False):
+        """
+        Takes either a single spectrogram (odim, T) or a padded batch of them (B, odim, Tmax)
+        """
         if normalize_before:
             c = (c - self.mean) / self.scale
-        c = self.input_conv(c.unsqueeze(0))
+        is_batch = c.dim() == 3
+        if not is_batch:
+            c = c.unsqueeze(0)
+        c = self.input_conv(c)
         for i in range(self.num_upsamples):
             c = self.upsamples[i](c)
             cs = 0.0  # initialize
@@ -72,6 +93,8 @@ class HiFiGANGenerator(torch.nn.Module):
                 cs = cs + self.blocks[i * self.num_blocks + j](c)
             c = cs / self.num_blocks
         c = self.output_conv(c)
+        if is_batch:
+            return c.squeeze(1)
         return c.squeeze(0).squeeze(0)
 
     def remove_weight_norm(self):
@@ -89,3 +112,51 @@ class HiFiGANGenerator(torch.nn.Module):
                 torch.nn.utils.weight_norm(m)
 
         self.apply(_apply_weight_norm)
+
+
+class ScriptedHiFiGANGenerator(torch.nn.Module):
+
+    def __init__(self, generator, upsample_factor):
+        """
+        Gives a traced TorchScript generator, which only takes
+        batches, the same interface as the HiFiGANGenerator.
+        """
+        super().__init__()
+        self.generator = generator
+        self.upsample_factor = upsample_factor
+
+    def forward(self, c):
+        """
+        Takes either a single spectrogram (odim, T) or a padded batch of them (B, odim, Tmax)
+        """
+        if c.dim() == 3:
+            return self.generator(c)
+        return self.generator(c.unsqueeze(0)).squeeze(0)
+
+
+def vocode_batch(mel2wav, mels, mel_lengths, context_frames=16):
+    """
+    Vocodes a padded batch of spectrograms (B, odim, Tmax) and returns
+    a list with one wave per spectrogram, cut to its true length.
+
+    Close to its end, the wave of a spectrogram that is shorter than the
+    batch would hear the padding through the receptive field of the
+    generator, so the last context_frames of every such spectrogram are
+    vocoded again on their own, with context_frames of context in front,
+    and replace the end of its batched wave. 12 frames cover the
+    receptive field of the HiFiGAN we use.
+    """
+    hop = mel2wav.upsample_factor
+    batch_waves = mel2wav(mels)
+    waves = list()
+    for mel, batch_wave, mel_length in zip(mels, batch_waves, mel_lengths):
+        mel_length = int(mel_length)
+        if mel_length == mels.shape[2]:
+            waves.append(batch_wave)
+        elif mel_length <= 2 * context_frames:
+            waves.append(mel2wav(mel[:, :mel_length]))
+        else:
+            tail_start = mel_length - context_frames
+            tail = mel2wav(mel[:, tail_start - context_frames:mel_length])[context_frames * hop:]
+            waves.append(torch.cat((batch_wave[:tail_start * hop], tail), 0))
+    return waves
@@ -0,0 +1,115 @@
+"""
+Single file bundles of everything InferenceFastSpeech2 needs to
+synthesize speech, so that deploying a model doesn't require the
+Models directory and the expensive parts of the initialization.
+
+A bundle is one file written with torch.save that holds a dict with
+a manifest describing its contents, the FastSpeech2 weights and its
+default utterance embedding, the HiFiGAN generator with weight norm
+already folded into its convolutions, the phone feature table and
+the language ID map. The HiFiGAN generator can be stored as a traced
+TorchScript module and the linear layers of FastSpeech2 can be
+quantized to int8.
+"""
+
+import io
+import os
+
+import torch
+
+from InferenceInterfaces.InferenceArchitectures.InferenceFastSpeech2 import FastSpeech2
+from InferenceInterfaces.InferenceArchitectures.InferenceHiFiGAN import HiFiGANGenerator
+from InferenceInterfaces.InferenceArchitectures.InferenceHiFiGAN import ScriptedHiFiGANGenerator
+from Preprocessing.ArticulatoryCombinedTextFrontend import FEATURE_SIZE
+from Preprocessing.ArticulatoryCombinedTextFrontend import PHONE_TO_ID
+from Preprocessing.ArticulatoryCombinedTextFrontend import get_language_id
+from Preprocessing.ArticulatoryCombinedTextFrontend import get_phone_feature_table
+from Preprocessing.ArticulatoryCombinedTextFrontend import set_phone_feature_table
+from Utility.utils import get_fastspeech2_architecture
+
+BUNDLE_FORMAT_VERSION = 1
+
+# every language get_language_id knows about
+LANGUAGES = ["de", "el", "es", "fi", "ru", "hu", "nl", "fr", "pt", "pl", "it", "en", "chr-w", "chr", "chr-e"]
+
+
+def export_bundle(model_name, path_to_bundle, hifigan_name="HiFiGAN_combined", torchscript=False, quantize=False):
+    """
+    Packs Models/FastSpeech2_<model_name>/best.pt and Models/<hifigan_name>/best.pt into a single bundle.
+
+    Args:
+        model_name: name of the FastSpeech2 model, as passed to InferenceFastSpeech2
+        path_to_bundle: file the bundle is written to
+        hifigan_name: directory of the HiFiGAN model within Models
+        torchscript: whether to store the HiFiGAN generator as a traced TorchScript module
+        quantize: whether to quantize the linear layers of FastSpeech2 to int8. Quantized models only run on the cpu.
+    """
+    checkpoint = torch.load(os.path.join("Models", f"FastSpeech2_{model_name}", "best.pt"), map_location='cpu')
+    architecture = checkpoint.get("architecture", get_fastspeech2_architecture(checkpoint["model"]))
+    phone2mel = FastSpeech2(weights=checkpoint["model"],
+                            lang_embs=architecture["lang_embs"],
+                            utt_embed_dim=architecture["utt_embed_dim"]).eval()
+    if quantize:
+        phone2mel = quantize_fastspeech2(phone2mel)
+    mel2wav = HiFiGANGenerator(path_to_weights=os.path.join("Models", hifigan_name, "best.pt")).eval()
+    if torchscript:
+        with torch.no_grad():
+            # the generator is fully convolutional, so a trace on any batch of spectrograms works for all lengths
+            traced_mel2wav = torch.jit.trace(mel2wav, torch.randn(1, 80, 64))
+        buffer = io.BytesIO()
+        torch.jit.save(traced_mel2wav, buffer)
+        mel2wav_data = buffer.getvalue()
+    else:
+        mel2wav_data = mel2wav.state_dict()
+    manifest = {"format_version" : BUNDLE_FORMAT_VERSION,
+                "model_name"     : model_name,
+                "hifigan_name"   : hifigan_name,
+                "architecture"   : architecture,
+                "torchscript"    : torchscript,
+                "quantized"      : quantize,
+                "feature_size"   : FEATURE_SIZE,
+                "sampling_rate"  : 48000,
+                "upsample_factor": mel2wav.upsample_factor,
+                "torch_version"  : torch.__version__}
+    if os.path.dirname(path_to_bundle) != "":
+        os.makedirs(os.path.dirname(path_to_bundle), exist_ok=True)
+    torch.save({"manifest"           : manifest,
+                "fastspeech2"        : phone2mel.state_dict(),
+                "default_emb"        : checkpoint["default_emb"],
+                "hifigan"            : mel2wav_data,
+                "phone_feature_table": get_phone_feature_table(),
+                "phone_to_id"        : dict(PHONE_TO_ID),
+                "language_ids"       : {language: int(get_language_id(language)) for language in LANGUAGES}}, path_to_bundle)
+    return manifest
+
+
+def load_bundle(path_to_bundle, alpha=1.0):
+    """
+    Returns the FastSpeech2 model, the HiFiGAN generator, the default
+    utterance embedding, the language ID map and the manifest of a
+    bundle. Also makes the text frontends use its phone feature table.
+    """
+    bundle = torch.load(path_to_bundle, map_location='cpu')
+    manifest = bundle["manifest"]
+    if manifest["format_version"] != BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"The bundle {path_to_bundle} has format version {manifest['format_version']}, but version {BUNDLE_FORMAT_VERSION} is required.")
+    if bundle["phone_to_id"] != PHONE_TO_ID:
+        raise ValueError(f"The bundle {path_to_bundle} was made with a different phone inventory than the one of this text frontend.")
+    set_phone_feature_table(bundle["phone_feature_table"])
+    architecture = manifest["architecture"]
+    if manifest["quantized"]:
+        # the quantized layers have to exist before their weights can be loaded
+        phone2mel = FastSpeech2(weights=None, lang_embs=architecture["lang_embs"], utt_embed_dim=architecture["utt_embed_dim"], alpha=alpha).eval()
+        phone2mel = quantize_fastspeech2(phone2mel)
+        phone2mel.load_state_dict(bundle["fastspeech2"])
+    else:
+        phone2mel = FastSpeech2(weights=bundle["fastspeech2"], lang_embs=architecture["lang_embs"], utt_embed_dim=architecture["utt_embed_dim"], alpha=alpha)
+    if manifest["torchscript"]:
+        mel2wav = ScriptedHiFiGANGenerator(torch.jit.load(io.BytesIO(bundle["hifigan"]), map_location='cpu'), upsample_factor=manifest["upsample_factor"])
+    else:
+        mel2wav = HiFiGANGenerator(weights=bundle["hifigan"])
+    return phone2mel, mel2wav, bundle["default_emb"], bundle["language_ids"], manifest
+
+
+def quantize_fastspeech2(phone2mel):
+    return torch.quantization.quantize_dynamic(phone2mel, {torch.nn.Linear}, dtype=torch.qint8)
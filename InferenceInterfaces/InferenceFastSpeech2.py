@@ -1,46 +1,62 @@
 import itertools
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-import librosa.display as lbd
-import matplotlib.pyplot as plt
-import noisereduce
-import sounddevice
 import soundfile
 import torch
+from torch.nn.utils.rnn import pad_sequence
 
 from InferenceInterfaces.InferenceArchitectures.InferenceFastSpeech2 import FastSpeech2
 from InferenceInterfaces.InferenceArchitectures.InferenceHiFiGAN import HiFiGANGenerator
+from InferenceInterfaces.InferenceArchitectures.InferenceHiFiGAN import vocode_batch
 from Preprocessing.ArticulatoryCombinedTextFrontend import ArticulatoryCombinedTextFrontend
 from Preprocessing.ArticulatoryCombinedTextFrontend import get_language_id
-from Preprocessing.ProsodicConditionExtractor import ProsodicConditionExtractor
+from Preprocessing.EmbeddingCache import EmbeddingCache
+from Preprocessing.PhonemeCache import PhonemeCache
+from Utility.utils import get_fastspeech2_architecture
 
 
 class InferenceFastSpeech2(torch.nn.Module):
 
-    def __init__(self, device="cpu", model_name="Meta", language="en", noise_reduce=False, alpha: float = 1.0):
+    def __init__(self, device="cpu", model_name="Meta", language="en", noise_reduce=False, alpha: float = 1.0, phoneme_cache: PhonemeCache = None,
+                 embedding_cache: EmbeddingCache = None, bundle_path=None):
+        """
+        If a bundle_path is given, the models are loaded from a bundle made by
+        InferenceInterfaces.InferenceBundle.export_bundle instead of from the Models directory.
+        """
         super().__init__()
         self.alpha: float = alpha
         self.device = device
-        self.text2phone = ArticulatoryCombinedTextFrontend(language=language, add_silence_to_end=True)
-        checkpoint = torch.load(os.path.join("Models", f"FastSpeech2_{model_name}", "best.pt"), map_location='cpu')
-        self.use_lang_id = True
-        try:
-            self.phone2mel = FastSpeech2(weights=checkpoint["model"], alpha=alpha) \
-                .to(torch.device(device))  # multi speaker multi language
-        except RuntimeError:
-            try:
-                self.use_lang_id = False
-                self.phone2mel = FastSpeech2(weights=checkpoint["model"], lang_embs=None, alpha=alpha) \
-                    .to(torch.device(device))  # multi speaker single language
-            except RuntimeError:
-                self.phone2mel = FastSpeech2(weights=checkpoint["model"], lang_embs=None, utt_embed_dim=None, alpha=alpha) \
-                    .to(torch.device(device))  # single speaker
-        self.mel2wav = HiFiGANGenerator(path_to_weights=os.path.join("Models", "HiFiGAN_combined", "best.pt")).to(torch.device(device))
-        self.default_utterance_embedding = checkpoint["default_emb"].to(self.device)
+        self.phoneme_cache = phoneme_cache  # shared by all the text frontends we create when switching languages
+        self.embedding_cache = embedding_cache if embedding_cache is not None else EmbeddingCache()
+        self.condition_extractors = dict()  # only built once a reference audio actually needs to be embedded
+        self.language_ids = None  # the language ID map of a bundle, otherwise get_language_id is used
+        if bundle_path is not None:
+            # the bundle has to be loaded before the text frontend is created, so the frontend uses its feature table
+            from InferenceInterfaces.InferenceBundle import load_bundle
+            self.phone2mel, self.mel2wav, default_utterance_embedding, self.language_ids, manifest = load_bundle(bundle_path, alpha=alpha)
+            if manifest["quantized"] and torch.device(device).type != "cpu":
+                raise ValueError(f"The bundle {bundle_path} contains a quantized model, which can only run on the cpu.")
+            architecture = manifest["architecture"]
+        else:
+            checkpoint = torch.load(os.path.join("Models", f"FastSpeech2_{model_name}", "best.pt"), map_location='cpu')
+            # checkpoints from before the architecture was stored in them are recognized by their parameters
+            architecture = checkpoint.get("architecture", get_fastspeech2_architecture(checkpoint["model"]))
+            self.phone2mel = FastSpeech2(weights=checkpoint["model"],
+                                         lang_embs=architecture["lang_embs"],
+                                         utt_embed_dim=architecture["utt_embed_dim"],
+                                         alpha=alpha)
+            self.mel2wav = HiFiGANGenerator(path_to_weights=os.path.join("Models", "HiFiGAN_combined", "best.pt"))
+            default_utterance_embedding = checkpoint["default_emb"]
+        self.text2phone = ArticulatoryCombinedTextFrontend(language=language, add_silence_to_end=True, cache=self.phoneme_cache)
+        self.use_lang_id = architecture["lang_embs"] is not None
+        self.phone2mel = self.phone2mel.to(torch.device(device))
+        self.mel2wav = self.mel2wav.to(torch.device(device))
+        self.default_utterance_embedding = default_utterance_embedding.to(self.device)
         self.phone2mel.eval()
         self.mel2wav.eval()
         if self.use_lang_id:
-            self.lang_id = get_language_id(language)
+            self.lang_id = self.get_language_id(language)
         else:
             self.lang_id = None
         self.to(torch.device(device))
@@ -50,11 +66,27 @@ class InferenceFastSpeech2(torch.nn.Module):
             self.update_noise_profile()
 
     def set_utterance_embedding(self, path_to_reference_audio):
-        wave, sr = soundfile.read(path_to_reference_audio)
-        self.default_utterance_embedding = ProsodicConditionExtractor(sr=sr).extract_condition_from_reference_wave(wave).to(self.device)
+        cache_key = EmbeddingCache.make_key(path_to_reference_audio)
+        utterance_embedding = self.embedding_cache.get(cache_key)
+        if utterance_embedding is None:
+            wave, sr = soundfile.read(path_to_reference_audio)
+            utterance_embedding = self.get_condition_extractor(sr).extract_condition_from_reference_wave(wave)
+            self.embedding_cache.put(cache_key, utterance_embedding)
+        self.default_utterance_embedding = utterance_embedding.to(self.device)
         if self.noise_reduce:
             self.update_noise_profile()
 
+    def get_condition_extractor(self, sr):
+        """
+        The extractor for the given sampling rate, which is created on
+        first use and kept around, since loading its speechbrain models
+        is expensive. speechbrain is only imported once this is called.
+        """
+        if (sr, str(self.device)) not in self.condition_extractors:
+            from Preprocessing.ProsodicConditionExtractor import ProsodicConditionExtractor
+            self.condition_extractors[(sr, str(self.device))] = ProsodicConditionExtractor(sr=sr, device=self.device)
+        return self.condition_extractors[(sr, str(self.device))]
+
     def update_noise_profile(self):
         self.noise_reduce = False
         self.prototypical_noise = self("~." * 100, input_is_phones=True).cpu().numpy()
@@ -64,16 +96,56 @@ class InferenceFastSpeech2(torch.nn.Module):
         """
         The id parameter actually refers to the shorthand. This has become ambiguous with the introduction of the actual language IDs
         """
-        self.text2phone = ArticulatoryCombinedTextFrontend(language=lang_id, add_silence_to_end=True)
+        self.text2phone = ArticulatoryCombinedTextFrontend(language=lang_id, add_silence_to_end=True, cache=self.phoneme_cache)
         if self.use_lang_id:
-            self.lang_id = get_language_id(lang_id).to(self.device)
+            self.lang_id = self.get_language_id(lang_id).to(self.device)
         else:
             self.lang_id = None
 
+    def get_language_id(self, language):
+        if self.language_ids is not None:
+            return torch.LongTensor([self.language_ids.get(language, 99)])
+        return get_language_id(language)
+
     def forward(self, text, view=False, durations=None, pitch=None, energy=None, input_is_phones=False):
+        phones = self.text2phone.string_to_tensor(text, input_phonemes=input_is_phones)
+        wave, mel, durations = self._synthesize(phones, durations=durations, pitch=pitch, energy=energy)
+        if view:
+            self._plot(text, wave, mel, durations)
+        if self.noise_reduce:
+            wave = self._reduce_noise(wave)
+        return wave
+
+    def _plot(self, text, wave, mel, durations):
+        import librosa.display as lbd
+        import matplotlib.pyplot as plt
+        from Utility.utils import cumsum_durations
+        fig, ax = plt.subplots(nrows=2, ncols=1)
+        ax[0].plot(wave.cpu().numpy())
+        lbd.specshow(mel.cpu().numpy(),
+                     ax=ax[1],
+                     sr=16000,
+                     cmap='GnBu',
+                     y_axis='mel',
+                     x_axis=None,
+                     hop_length=256)
+        ax[0].yaxis.set_visible(False)
+        ax[1].yaxis.set_visible(False)
+        duration_splits, label_positions = cumsum_durations(durations.cpu().numpy())
+        ax[1].set_xticks(duration_splits, minor=True)
+        ax[1].xaxis.grid(True, which='minor')
+        ax[1].set_xticks(label_positions, minor=False)
+        ax[1].set_xticklabels(self.text2phone.get_phone_string(text))
+        ax[0].set_title(text)
+        plt.subplots_adjust(left=0.05, bottom=0.1, right=0.95, top=.9, wspace=0.0, hspace=0.0)
+        plt.show()
+
+    def _synthesize(self, phones, durations=None, pitch=None, energy=None):
+        """
+        Takes the articulatory features of the phones and returns the wave, the spectrogram and the durations
+        """
         with torch.inference_mode():
-            phones = self.text2phone.string_to_tensor(text, input_phonemes=input_is_phones).to(torch.device(self.device))
-            mel, durations, pitch, energy = self.phone2mel(phones,
+            mel, durations, pitch, energy = self.phone2mel(phones.to(torch.device(self.device)),
                                                            return_duration_pitch_energy=True,
                                                            utterance_embedding=self.default_utterance_embedding,
                                                            durations=durations,
@@ -82,33 +154,107 @@ class InferenceFastSpeech2(torch.nn.Module):
                                                            lang_id=self.lang_id)
             mel = mel.transpose(0, 1)
             wave = self.mel2wav(mel)
+        return wave, mel, durations
+
+    def _reduce_noise(self, wave):
+        import noisereduce
+        return torch.tensor(noisereduce.reduce_noise(y=wave.cpu().numpy(), y_noise=self.prototypical_noise, sr=48000, stationary=True), device=self.device)
+
+    def stream(self, text, view=False, chunk_frames=64, context_frames=16, crossfade_frames=2, input_is_phones=False):
+        """
+        Synthesizes a text and yields the wave in blocks as soon as they are vocoded.
+
+        FastSpeech2 produces the whole spectrogram in one pass, but HiFiGAN
+        only needs a few frames around a chunk to vocode it exactly like
+        it would within the whole spectrogram, so the spectrogram is
+        vocoded chunk by chunk, each with context_frames of context on
+        both sides, and neighbouring chunks are cross-faded over
+        crossfade_frames to hide any remaining seams. 12 frames cover the
+        receptive field of the HiFiGAN we use.
+
+        Args:
+            text: The string to be read
+            view: Whether to plot the wave and the spectrogram once the last block has been consumed
+            chunk_frames: Amount of spectrogram frames vocoded per block
+            context_frames: Amount of spectrogram frames of context on either side of a chunk
+            crossfade_frames: Amount of spectrogram frames over which neighbouring blocks are cross-faded
+            input_is_phones: Whether the string is already phonemized
+
+        Yields:
+            1D tensors with consecutive parts of the wave
+        """
+        hop = self.mel2wav.upsample_factor
+        with torch.inference_mode():
+            phones = self.text2phone.string_to_tensor(text, input_phonemes=input_is_phones).to(torch.device(self.device))
+            mel, durations, _, _ = self.phone2mel(phones,
+                                                  return_duration_pitch_energy=True,
+                                                  utterance_embedding=self.default_utterance_embedding,
+                                                  lang_id=self.lang_id)
+            mel = mel.transpose(0, 1)
+        num_frames = mel.shape[1]
+        previous_tail = None
+        blocks = list()
+        for start in range(0, num_frames, chunk_frames):
+            end = min(start + chunk_frames, num_frames)
+            # every chunk but the last is vocoded a little further, so it overlaps with the next one
+            overlap_end = min(end + crossfade_frames, num_frames)
+            context_start = max(start - context_frames, 0)
+            context_end = min(overlap_end + context_frames, num_frames)
+            with torch.inference_mode():
+                wave = self.mel2wav(mel[:, context_start:context_end])
+                wave = wave[(start - context_start) * hop:(overlap_end - context_start) * hop]
+                if previous_tail is not None:
+                    fade_in = torch.linspace(0.0, 1.0, len(previous_tail), device=wave.device)
+                    wave = torch.cat((previous_tail * (1.0 - fade_in) + wave[:len(previous_tail)] * fade_in, wave[len(previous_tail):]), 0)
+                previous_tail = wave[(end - start) * hop:] if overlap_end > end else None
+                wave = wave[:(end - start) * hop]
+            if self.noise_reduce:
+                wave = self._reduce_noise(wave)
+            if view:
+                blocks.append(wave)
+            yield wave
         if view:
-            from Utility.utils import cumsum_durations
-            fig, ax = plt.subplots(nrows=2, ncols=1)
-            ax[0].plot(wave.cpu().numpy())
-            lbd.specshow(mel.cpu().numpy(),
-                         ax=ax[1],
-                         sr=16000,
-                         cmap='GnBu',
-                         y_axis='mel',
-                         x_axis=None,
-                         hop_length=256)
-            ax[0].yaxis.set_visible(False)
-            ax[1].yaxis.set_visible(False)
-            duration_splits, label_positions = cumsum_durations(durations.cpu().numpy())
-            ax[1].set_xticks(duration_splits, minor=True)
-            ax[1].xaxis.grid(True, which='minor')
-            ax[1].set_xticks(label_positions, minor=False)
-            ax[1].set_xticklabels(self.text2phone.get_phone_string(text))
-            ax[0].set_title(text)
-            plt.subplots_adjust(left=0.05, bottom=0.1, right=0.95, top=.9, wspace=0.0, hspace=0.0)
-            plt.show()
-        if self.noise_reduce:
-            wave = torch.tensor(noisereduce.reduce_noise(y=wave.cpu().numpy(), y_noise=self.prototypical_noise, sr=48000, stationary=True), device=self.device)
-        return wave
+            self._plot(text, torch.cat(blocks, 0), mel, durations)
 
-    def read_to_file(self, text_list, file_location, silent=False, dur_list=None, pitch_list=None, energy_list=None):
+    def synthesize_batch(self, texts, input_is_phones=False):
         """
+        Synthesizes several utterances with one pass through FastSpeech2 and HiFiGAN.
+
+        Args:
+            texts: A list of strings to be read
+            input_is_phones: Whether the strings are already phonemized
+
+        Returns:
+            A list with one wave per text, in the same order as the texts
+        """
+        if len(texts) == 0:
+            return list()
+        with torch.inference_mode():
+            phones = self.text2phone.strings_to_tensors(texts, input_phonemes=input_is_phones)
+            phone_lengths = torch.LongTensor([len(phone_sequence) for phone_sequence in phones])
+            phones = pad_sequence(phones, batch_first=True).to(torch.device(self.device))
+            lang_ids = None
+            if self.lang_id is not None:
+                lang_ids = self.lang_id.expand(len(texts))
+            mels, mel_lengths, _, _, _ = self.phone2mel.batch_forward(phones,
+                                                                      phone_lengths,
+                                                                      utterance_embedding=self.default_utterance_embedding,
+                                                                      lang_ids=lang_ids)
+            waves = vocode_batch(self.mel2wav, mels.transpose(1, 2), mel_lengths)
+        wave_list = list()
+        for wave in waves:
+            if self.noise_reduce:
+                wave = self._reduce_noise(wave)
+            wave_list.append(wave)
+        return wave_list
+
+    def read_to_file(self, text_list, file_location, silent=False, dur_list=None, pitch_list=None, energy_list=None, frontend_window=8):
+        """
+        The text frontend prepares the next few sentences in a background
+        thread while the current ones are synthesized, and every sentence
+        is written to the file as soon as it is done, so long documents
+        are never held in memory as a whole.
+
         Args:
             silent: Whether to be verbose about the process
             text_list: A list of strings to be read
@@ -116,6 +262,7 @@ class InferenceFastSpeech2(torch.nn.Module):
             energy_list: list of energy tensors to be used for the texts
             pitch_list: list of pitch tensors to be used for the texts
             dur_list: list of duration tensors to be used for the texts
+            frontend_window: Amount of sentences the text frontend processes in one go
         """
         if not dur_list:
             dur_list = []
@@ -123,35 +270,43 @@ class InferenceFastSpeech2(torch.nn.Module):
             pitch_list = []
         if not energy_list:
             energy_list = []
-        wav = None
-        silence = torch.zeros([24000])
-        for (text, durations, pitch, energy) in itertools.zip_longest(text_list, dur_list, pitch_list, energy_list):
-            if text.strip() != "":
-                if not silent:
-                    print("Now synthesizing: {}".format(text))
-                if wav is None:
+        sentences = [(text, durations, pitch, energy) for (text, durations, pitch, energy) in itertools.zip_longest(text_list, dur_list, pitch_list, energy_list)
+                     if text.strip() != ""]
+        windows = [sentences[index:index + frontend_window] for index in range(0, len(sentences), frontend_window)]
+        silence = torch.zeros([24000]).numpy()
+        with ThreadPoolExecutor(max_workers=1) as frontend, soundfile.SoundFile(file_location, mode="w", samplerate=48000, channels=1) as output_file:
+            # phonemizing a whole window in one go is much cheaper than invoking the g2p backend once per sentence
+            next_window = frontend.submit(self.text2phone.strings_to_tensors, [text for (text, _, _, _) in windows[0]]) if len(windows) > 0 else None
+            for window_index, window in enumerate(windows):
+                phone_list = next_window.result()
+                if window_index + 1 < len(windows):
+                    next_window = frontend.submit(self.text2phone.strings_to_tensors, [text for (text, _, _, _) in windows[window_index + 1]])
+                for (text, durations, pitch, energy), phones in zip(window, phone_list):
+                    if not silent:
+                        print("Now synthesizing: {}".format(text))
                     if durations is not None:
                         durations = durations.to(self.device)
                     if pitch is not None:
                         pitch = pitch.to(self.device)
                     if energy is not None:
                         energy = energy.to(self.device)
-                    wav = self(text, durations=durations, pitch=pitch, energy=energy).cpu()
-                    wav = torch.cat((wav, silence), 0)
-                else:
-                    wav = torch.cat((wav, self(text, durations=durations,  #
-                                               pitch=pitch,  #
-                                               energy=energy).cpu()), 0)
-                    wav = torch.cat((wav, silence), 0)
-        soundfile.write(file=file_location, data=wav.cpu().numpy(), samplerate=48000)
+                    wave, _, _ = self._synthesize(phones, durations=durations, pitch=pitch, energy=energy)
+                    if self.noise_reduce:
+                        wave = self._reduce_noise(wave)
+                    output_file.write(wave.cpu().numpy())
+                    output_file.write(silence)
 
     def read_aloud(self, text, view=False, blocking=False):
         if text.strip() == "":
             return
+        import sounddevice
+        if blocking:
+            # playback starts as soon as the first block is vocoded instead of after the whole text, the plot comes once it is through
+            with sounddevice.OutputStream(samplerate=48000, channels=1, dtype="float32") as output_stream:
+                for wave_block in self.stream(text, view=view):
+                    output_stream.write(wave_block.cpu().float().unsqueeze(1).numpy())
+                output_stream.write(torch.zeros([36000, 1]).numpy())
+            return
         wav = self(text, view).cpu()
         wav = torch.cat((wav, torch.zeros([24000])), 0)
-        if not blocking:
-            sounddevice.play(wav.numpy(), samplerate=48000)
-        else:
-            sounddevice.play(torch.cat((wav, torch.zeros([12000])), 0).numpy(), samplerate=48000)
-            sounddevice.wait()
+        sounddevice.play(wav.numpy(), samplerate=48000)
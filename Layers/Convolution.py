@@ -6,6 +6,8 @@
 
 from torch import nn
 
+from Utility.utils import masked_group_norm
+
 
 class ConvolutionModule(nn.Module):
     """
@@ -28,12 +30,13 @@ class ConvolutionModule(nn.Module):
         self.pointwise_conv2 = nn.Conv1d(channels, channels, kernel_size=1, stride=1, padding=0, bias=bias, )
         self.activation = activation
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         """
         Compute convolution module.
 
         Args:
             x (torch.Tensor): Input tensor (#batch, time, channels).
+            mask (torch.Tensor): Mask of the non-padded frames (#batch, 1, time), keeps the padding from leaking into the sequence.
 
         Returns:
             torch.Tensor: Output tensor (#batch, time, channels).
@@ -47,8 +50,13 @@ class ConvolutionModule(nn.Module):
         x = nn.functional.glu(x, dim=1)  # (batch, channel, dim)
 
         # 1D Depthwise Conv
-        x = self.depthwise_conv(x)
-        x = self.activation(self.norm(x))
+        if mask is not None:
+            x = x.masked_fill(~mask, 0.0)
+            x = self.depthwise_conv(x)
+            x = self.activation(masked_group_norm(self.norm, x, mask))
+        else:
+            x = self.depthwise_conv(x)
+            x = self.activation(self.norm(x))
 
         x = self.pointwise_conv2(x)
 
@@ -120,7 +120,7 @@ class EncoderLayer(nn.Module):
             residual = x
             if self.normalize_before:
                 x = self.norm_conv(x)
-            x = residual + self.dropout(self.conv_module(x))
+            x = residual + self.dropout(self.conv_module(x, mask))
             if not self.normalize_before:
                 x = self.norm_conv(x)
 
@@ -55,6 +55,9 @@ class VariancePredictor(torch.nn.Module, ABC):
         """
         xs = xs.transpose(1, -1)  # (B, idim, Tmax)
         for f in self.conv:
+            if x_masks is not None:
+                # the padding must not leak into the neighbouring frames of the sequence
+                xs = xs.masked_fill(x_masks.transpose(1, 2), 0.0)
             xs = f(xs)  # (B, C, Tmax)
 
         xs = self.linear(xs.transpose(1, 2))  # (B, Tmax, 1)
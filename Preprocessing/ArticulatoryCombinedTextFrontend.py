@@ -1,3 +1,5 @@
+import hashlib
+import os
 import re
 import sys
 
@@ -5,9 +7,204 @@ import panphon
 import phonemizer
 import torch
 
+from Preprocessing.PhonemeCache import PhonemeCache
 from Preprocessing.papercup_features import generate_feature_table
 
 
+PHONE_TO_ID = {  # this lookup must be updated manually, because the only
+    # other way would be extracting them from a set, which can be non-deterministic
+    '~': 0,
+    '#': 1,
+    '?': 2,
+    '!': 3,
+    '.': 4,
+    'ɜ': 5,
+    'ɫ': 6,
+    'ə': 7,
+    'ɚ': 8,
+    'a': 9,
+    'ð': 10,
+    'ɛ': 11,
+    'ɪ': 12,
+    'ᵻ': 13,
+    'ŋ': 14,
+    'ɔ': 15,
+    'ɒ': 16,
+    'ɾ': 17,
+    'ʃ': 18,
+    'θ': 19,
+    'ʊ': 20,
+    'ʌ': 21,
+    'ʒ': 22,
+    'æ': 23,
+    'b': 24,
+    'ʔ': 25,
+    'd': 26,
+    'e': 27,
+    'f': 28,
+    'g': 29,
+    'h': 30,
+    'i': 31,
+    'j': 32,
+    'k': 33,
+    'l': 34,
+    'm': 35,
+    'n': 36,
+    'ɳ': 37,
+    'o': 38,
+    'p': 39,
+    'ɡ': 40,
+    'ɹ': 41,
+    'r': 42,
+    's': 43,
+    't': 44,
+    'u': 45,
+    'v': 46,
+    'w': 47,
+    'x': 48,
+    'z': 49,
+    'ʀ': 50,
+    'ø': 51,
+    'ç': 52,
+    'ɐ': 53,
+    'œ': 54,
+    'y': 55,
+    'ʏ': 56,
+    'ɑ': 57,
+    'c': 58,
+    'ɲ': 59,
+    'ɣ': 60,
+    'ʎ': 61,
+    'β': 62,
+    'ʝ': 63,
+    'ɟ': 64,
+    'q': 65,
+    'ɕ': 66,
+    'ʲ': 67,
+    'ɭ': 68,
+    'ɵ': 69,
+    'ʑ': 70,
+    'ʋ': 71,
+    'ʁ': 72,
+    'ɨ': 73,
+    'ʂ': 74,
+    'ɬ': 75,
+    # Tone letters: https://en.wikipedia.org/wiki/Tone_letter
+    # They are usually combined like the following:
+    # ˩˥ ˧˥ ˨˦ ˩˧ ˩˩˧
+    # ˥˩ ˥˧ ˦˨ ˧˩ ˥˥˧
+    '\u02e5': 76,  # ◌˥
+    '\u02e6': 77,  # ◌˦
+    '\u02e7': 78,  # ◌˧
+    '\u02e8': 79,  # ◌˨
+    '\u02e9': 80,  # ◌˩
+    # Lengthened and shortened vowels are grammatically important in some languages
+    # https://en.wikipedia.org/wiki/Vowel_length
+    '\u02d0': 81,  # ◌ː
+    '\u02d1': 82,  # ◌ˑ
+    '\u0306': 83,  # ◌̆
+    # Stress impacts things like compound noun formation, dessert vs desert,
+    # among other things
+    '\u02c8': 84,  # ˈ (primary) stress mark
+    '\u02cc': 85,  # ˌ secondary stress
+    # for use by Russian, among other languages
+    # see also: https://www.phon.ucl.ac.uk/home/wells/ipa-unicode.htm
+    '\u02bc': 86,
+    '\u02b4': 87,
+    '\u02b0': 88,
+    '\u02b1': 89,
+    '\u02b7': 90,
+    '\u02e0': 91,
+    '\u02e4': 92,
+    '\u02de': 93,
+
+}  # for the states of the ctc loss and dijkstra/mas in the aligner
+
+
+FEATURE_SIZE: int = 88
+
+# bump whenever the phone strings change in a way that get_frontend_version can't notice by itself
+FRONTEND_VERSION: int = 1
+
+_phone_to_vector = None
+_phone_feature_table = None
+_frontend_version = None
+
+
+def get_phone_to_vector():
+    """
+    Maps every phone to its articulatory feature vector, which
+    consists of the papercup features followed by the panphon
+    features. Built on the first call and cached afterwards.
+    """
+    global _phone_to_vector
+    if _phone_to_vector is None:
+        feature_table = panphon.FeatureTable()
+        phone_to_vector_papercup = generate_feature_table()
+        phone_to_vector = dict()
+        for phone in phone_to_vector_papercup:
+            panphon_features = feature_table.word_to_vector_list(phone, numeric=True)
+            if panphon_features == []:
+                panphon_features = [[0] * 24]
+            phone_to_vector[phone] = phone_to_vector_papercup[phone] + panphon_features[0]
+        _phone_to_vector = phone_to_vector
+    return _phone_to_vector
+
+
+def get_phone_feature_table():
+    """
+    Dense (num_phones, FEATURE_SIZE) tensor in which row i holds
+    the articulatory features of the phone with ID i, so a
+    sequence of IDs can be vectorized with a single index op.
+    """
+    global _phone_feature_table
+    if _phone_feature_table is None:
+        phone_to_vector = get_phone_to_vector()
+        table = torch.zeros([len(PHONE_TO_ID), FEATURE_SIZE])
+        for phone, phone_id in PHONE_TO_ID.items():
+            table[phone_id] = torch.Tensor(phone_to_vector[phone])
+        _phone_feature_table = table
+    return _phone_feature_table
+
+
+def set_phone_feature_table(table):
+    """
+    Uses a precomputed feature table, e.g. the one from an inference
+    bundle, so that the panphon features never have to be built.
+    """
+    global _phone_feature_table, _frontend_version
+    if table.shape != (len(PHONE_TO_ID), FEATURE_SIZE):
+        raise ValueError(f"The phone feature table has shape {tuple(table.shape)}, but {(len(PHONE_TO_ID), FEATURE_SIZE)} is required.")
+    _phone_feature_table = table
+    _frontend_version = None
+
+
+def get_frontend_version():
+    """
+    Hash of everything apart from the input that decides what the
+    frontend produces: FRONTEND_VERSION, the code of the frontend and
+    of the Cherokee g2p, the versions of phonemizer and espeak, the
+    phone IDs and the feature table. Cached results are only valid
+    for the frontend version they were made with.
+    """
+    global _frontend_version
+    if _frontend_version is None:
+        version_hash = hashlib.sha1(str(FRONTEND_VERSION).encode("utf8"))
+        for source_file in ["ArticulatoryCombinedTextFrontend.py", "lang_utils_chr.py"]:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source_file), mode="rb") as source:
+                version_hash.update(source.read())
+        try:
+            from phonemizer.backend import EspeakBackend
+            espeak_version = str(EspeakBackend.version())
+        except Exception:
+            espeak_version = "unknown"  # only the Cherokee g2p can work without espeak
+        version_hash.update(f"{getattr(phonemizer, '__version__', 'unknown')}\u0000{espeak_version}".encode("utf8"))
+        version_hash.update(repr(sorted(PHONE_TO_ID.items())).encode("utf8"))
+        version_hash.update(get_phone_feature_table().float().numpy().tobytes())
+        _frontend_version = version_hash.hexdigest()
+    return _frontend_version
+
+
 class ArticulatoryCombinedTextFrontend:
 
     def __init__(self,
@@ -25,10 +222,15 @@ class ArticulatoryCombinedTextFrontend:
                  silent=True,
                  allow_unknown=False,
                  add_silence_to_end=True,
-                 strip_silence=True):
+                 strip_silence=True,
+                 cache: PhonemeCache = None):
         """
         Mostly preparing ID lookups
+
+        If a PhonemeCache is given, phone strings and feature
+        matrices are looked up there before running the g2p.
         """
+        self.cache = cache
         self.strip_silence = strip_silence
         self.use_word_boundaries = use_word_boundaries
         self.allow_unknown = allow_unknown
@@ -36,7 +238,6 @@ class ArticulatoryCombinedTextFrontend:
         self.use_prosody = use_prosody
         self.use_stress = use_lexical_stress
         self.add_silence_to_end = add_silence_to_end
-        self.feature_table = panphon.FeatureTable()
 
         if language == "en":
             self.g2p_lang = "en-us"
@@ -128,126 +329,14 @@ class ArticulatoryCombinedTextFrontend:
             print("Language not supported yet")
             sys.exit()
 
-        self.phone_to_vector_papercup = generate_feature_table()
-
-        self.phone_to_vector = dict()
-        for phone in self.phone_to_vector_papercup:
-            panphon_features = self.feature_table.word_to_vector_list(phone, numeric=True)
-            if panphon_features == []:
-                panphon_features = [[0] * 24]
-            papercup_features = self.phone_to_vector_papercup[phone]
-            self.phone_to_vector[phone] = papercup_features + panphon_features[0]
-
-        self.phone_to_id = {  # this lookup must be updated manually, because the only
-            # other way would be extracting them from a set, which can be non-deterministic
-            '~': 0,
-            '#': 1,
-            '?': 2,
-            '!': 3,
-            '.': 4,
-            'ɜ': 5,
-            'ɫ': 6,
-            'ə': 7,
-            'ɚ': 8,
-            'a': 9,
-            'ð': 10,
-            'ɛ': 11,
-            'ɪ': 12,
-            'ᵻ': 13,
-            'ŋ': 14,
-            'ɔ': 15,
-            'ɒ': 16,
-            'ɾ': 17,
-            'ʃ': 18,
-            'θ': 19,
-            'ʊ': 20,
-            'ʌ': 21,
-            'ʒ': 22,
-            'æ': 23,
-            'b': 24,
-            'ʔ': 25,
-            'd': 26,
-            'e': 27,
-            'f': 28,
-            'g': 29,
-            'h': 30,
-            'i': 31,
-            'j': 32,
-            'k': 33,
-            'l': 34,
-            'm': 35,
-            'n': 36,
-            'ɳ': 37,
-            'o': 38,
-            'p': 39,
-            'ɡ': 40,
-            'ɹ': 41,
-            'r': 42,
-            's': 43,
-            't': 44,
-            'u': 45,
-            'v': 46,
-            'w': 47,
-            'x': 48,
-            'z': 49,
-            'ʀ': 50,
-            'ø': 51,
-            'ç': 52,
-            'ɐ': 53,
-            'œ': 54,
-            'y': 55,
-            'ʏ': 56,
-            'ɑ': 57,
-            'c': 58,
-            'ɲ': 59,
-            'ɣ': 60,
-            'ʎ': 61,
-            'β': 62,
-            'ʝ': 63,
-            'ɟ': 64,
-            'q': 65,
-            'ɕ': 66,
-            'ʲ': 67,
-            'ɭ': 68,
-            'ɵ': 69,
-            'ʑ': 70,
-            'ʋ': 71,
-            'ʁ': 72,
-            'ɨ': 73,
-            'ʂ': 74,
-            'ɬ': 75,
-            # Tone letters: https://en.wikipedia.org/wiki/Tone_letter
-            # They are usually combined like the following:
-            # ˩˥ ˧˥ ˨˦ ˩˧ ˩˩˧
-            # ˥˩ ˥˧ ˦˨ ˧˩ ˥˥˧
-            '\u02e5': 76,  # ◌˥
-            '\u02e6': 77,  # ◌˦
-            '\u02e7': 78,  # ◌˧
-            '\u02e8': 79,  # ◌˨
-            '\u02e9': 80,  # ◌˩
-            # Lengthened and shortened vowels are grammatically important in some languages
-            # https://en.wikipedia.org/wiki/Vowel_length
-            '\u02d0': 81,  # ◌ː
-            '\u02d1': 82,  # ◌ˑ
-            '\u0306': 83,  # ◌̆
-            # Stress impacts things like compound noun formation, dessert vs desert,
-            # among other things
-            '\u02c8': 84,  # ˈ (primary) stress mark
-            '\u02cc': 85,  # ˌ secondary stress
-            # for use by Russian, among other languages
-            # see also: https://www.phon.ucl.ac.uk/home/wells/ipa-unicode.htm
-            '\u02bc': 86,
-            '\u02b4': 87,
-            '\u02b0': 88,
-            '\u02b1': 89,
-            '\u02b7': 90,
-            '\u02e0': 91,
-            '\u02e4': 92,
-            '\u02de': 93,
-
-            }  # for the states of the ctc loss and dijkstra/mas in the aligner
-
+        self.phone_to_id = PHONE_TO_ID
         self.id_to_phone = {v: k for k, v in self.phone_to_id.items()}
+        # built only once per process and shared by all frontends
+        self.phone_feature_table = get_phone_feature_table()
+        self.version = get_frontend_version()
+        if self.cache is not None:
+            # entries from any other version of the frontend would be stale
+            self.cache.set_version(self.version)
 
     def string_to_tensor(self, text, view=False, device="cpu", handle_missing=True, input_phonemes=False):
         """
@@ -255,43 +344,155 @@ class ArticulatoryCombinedTextFrontend:
         turns graphemes into phonemes and then vectorizes
         the sequence as articulatory features
         """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(text, include_eos_symbol=True, input_phonemes=input_phonemes)
+            cached = self.cache.get(cache_key)
+            if cached is not None and cached[1] is not None:
+                if view:
+                    print("Phonemes: \n{}\n".format(cached[0]))
+                return cached[1].clone().to(device)
         if input_phonemes:
             phones = text
         else:
             phones = self.get_phone_string(text=text, include_eos_symbol=True)
         if view:
             print("Phonemes: \n{}\n".format(phones))
-        phones_vector = list()
-        # turn into numeric vectors
+        return self._vectorize_phones(phones, cache_key=cache_key, device=device, handle_missing=handle_missing)
+
+    def strings_to_tensors(self, texts, device="cpu", handle_missing=True, input_phonemes=False, n_jobs=1):
+        """
+        Same as string_to_tensor, but for a whole list of texts,
+        so that the g2p only has to be invoked once for all of them.
+        """
+        tensors = [None] * len(texts)
+        cache_keys = [None] * len(texts)
+        todo = list()
+        for index, text in enumerate(texts):
+            if self.cache is not None:
+                cache_keys[index] = self._cache_key(text, include_eos_symbol=True, input_phonemes=input_phonemes)
+                cached = self.cache.get(cache_keys[index])
+                if cached is not None and cached[1] is not None:
+                    tensors[index] = cached[1].clone().to(device)
+                    continue
+            todo.append(index)
+        if input_phonemes:
+            phone_strings = [texts[index] for index in todo]
+        else:
+            phone_strings = self.get_phone_strings([texts[index] for index in todo], include_eos_symbol=True, n_jobs=n_jobs)
+        for index, phones in zip(todo, phone_strings):
+            tensors[index] = self._vectorize_phones(phones, cache_key=cache_keys[index], device=device, handle_missing=handle_missing)
+        return tensors
+
+    def phones_to_ids(self, phones, handle_missing=True):
+        """
+        Turns a phone string into a LongTensor of phone IDs
+        """
+        phone_ids = list()
         for char in phones:
             if handle_missing:
                 try:
-                    phones_vector.append(self.phone_to_vector[char])
+                    phone_ids.append(self.phone_to_id[char])
                 except KeyError:
                     print("unknown phoneme: {}".format(char))
             else:
-                phones_vector.append(self.phone_to_vector[char])  # leave error handling to elsewhere
+                phone_ids.append(self.phone_to_id[char])  # leave error handling to elsewhere
+        return torch.LongTensor(phone_ids)
+
+    def vectors_to_ids(self, vectors):
+        """
+        Reverse lookup: turns a sequence of articulatory feature
+        vectors (T, FEATURE_SIZE) back into a LongTensor of phone IDs
+        by matching all of them against the feature table at once.
+        """
+        matches = (vectors.cpu().unsqueeze(1) == self.phone_feature_table.unsqueeze(0)).all(dim=-1)  # (T, num_phones)
+        found, phone_ids = matches.max(dim=1)
+        if not found.all():
+            raise KeyError(f"No phone matches the feature vector at position {int((~found).nonzero()[0])}")
+        return phone_ids
+
+    def _vectorize_phones(self, phones, cache_key=None, device="cpu", handle_missing=True):
+        phone_ids = self.phones_to_ids(phones, handle_missing=handle_missing)
+        found_unknown = len(phone_ids) != len(phones)
+        # turn into numeric vectors
+        phones_tensor = self.phone_feature_table[phone_ids].to(device)
+        if cache_key is not None and not found_unknown:
+            # only complete sequences are cached, so a hit is valid regardless of handle_missing
+            self.cache.put(cache_key, phones, phones_tensor)
+        return phones_tensor
 
-        return torch.Tensor(phones_vector, device=device)
+    def get_phone_strings(self, texts, include_eos_symbol=True, n_jobs=1):
+        """
+        Same as get_phone_string, but for a whole list of texts.
+        espeak is only invoked once for all of them and can use
+        n_jobs parallel backends.
+        """
+        phone_strings = [None] * len(texts)
+        cache_keys = [None] * len(texts)
+        todo = list()
+        for index, text in enumerate(texts):
+            if self.cache is not None:
+                cache_keys[index] = self._cache_key(text, include_eos_symbol=include_eos_symbol)
+                cached = self.cache.get(cache_keys[index])
+                if cached is not None:
+                    phone_strings[index] = cached[0]
+                    continue
+            todo.append(index)
+        raw_phone_strings = self._phonemize([texts[index] for index in todo], n_jobs=n_jobs)
+        for index, raw_phones in zip(todo, raw_phone_strings):
+            phone_strings[index] = self._postprocess_phones(raw_phones, include_eos_symbol=include_eos_symbol)
+            if cache_keys[index] is not None:
+                self.cache.put(cache_keys[index], phone_strings[index])
+        return phone_strings
 
     def get_phone_string(self, text, include_eos_symbol=True):
-        # expand abbreviations
-        utt = self.expand_abbreviations(text)
-        # phonemize
-        phones: str
+        if self.cache is not None:
+            cache_key = self._cache_key(text, include_eos_symbol=include_eos_symbol)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached[0]
+            phones = self._get_phone_string(text, include_eos_symbol=include_eos_symbol)
+            self.cache.put(cache_key, phones)
+            return phones
+        return self._get_phone_string(text, include_eos_symbol=include_eos_symbol)
+
+    def _cache_key(self, text, include_eos_symbol=True, input_phonemes=False):
+        return PhonemeCache.make_key(self.version, self.g2p_lang, text, (input_phonemes,
+                                                                         include_eos_symbol,
+                                                                         self.use_word_boundaries,
+                                                                         self.use_explicit_eos,
+                                                                         self.use_prosody,
+                                                                         self.use_stress,
+                                                                         self.add_silence_to_end,
+                                                                         self.strip_silence))
+
+    def _get_phone_string(self, text, include_eos_symbol=True):
+        return self._postprocess_phones(self._phonemize([text])[0], include_eos_symbol=include_eos_symbol)
+
+    def _phonemize(self, texts, n_jobs=1):
+        """
+        Runs the g2p over a list of texts and returns the raw phone strings
+        """
+        if len(texts) == 0:
+            return list()
         if self.g2p_lang.startswith("chr"):
             from Preprocessing.lang_utils_chr import chr_mco_ipa
-            phones = chr_mco_ipa(text)
-        else:
-            phones = phonemizer.phonemize(utt,
-                                          language_switch='remove-flags',
-                                          backend="espeak",
-                                          language=self.g2p_lang,
-                                          preserve_punctuation=True,
-                                          strip=True,
-                                          punctuation_marks=';:,.!?¡¿—…"«»“”~/',
-                                          with_stress=self.use_stress)
-
+            return [chr_mco_ipa(text) for text in texts]
+        # expand abbreviations
+        # phonemizer works line by line, so newlines inside of a text would break the mapping to the inputs.
+        # They end up as spaces in the postprocessing anyway.
+        utts = [self.expand_abbreviations(text).replace("\n", " ") for text in texts]
+        return phonemizer.phonemize(utts,
+                                    language_switch='remove-flags',
+                                    backend="espeak",
+                                    language=self.g2p_lang,
+                                    preserve_punctuation=True,
+                                    strip=True,
+                                    punctuation_marks=';:,.!?¡¿—…"«»“”~/',
+                                    with_stress=self.use_stress,
+                                    njobs=n_jobs)
+
+    def _postprocess_phones(self, phones, include_eos_symbol=True):
         phones = re.sub('[\u201C\u201D\u201E\u201F\u2033\u2036]', '"', phones)
         phones = re.sub("[\u2018\u2019\u201A\u201B\u2032\u2035]", "'", phones)
         phones = phones.replace(";", ",").replace("/", " ").replace("—", "").replace(":", ",").replace('"', ",") \
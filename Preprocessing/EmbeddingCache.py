@@ -0,0 +1,44 @@
+import numpy as np
+import soundfile
+import torch
+
+from Utility.KeyValueStore import KeyValueStore
+from Utility.utils import hash_file
+
+
+class EmbeddingCache:
+
+    def __init__(self, path_to_db=None, max_entries_in_memory=256):
+        """
+        Store for the utterance embeddings of reference audios.
+
+        Entries are keyed by the content of the audio file and its
+        sampling rate, so renamed or copied files are still found,
+        while a file that is overwritten with a new recording is
+        not. Lookups go to an in-process LRU first and then to an
+        sqlite file on disk, if a path is given.
+        """
+        self.store = KeyValueStore(table="utterance_embeddings",
+                                   encode=lambda embedding: embedding.numpy().tobytes(),
+                                   decode=lambda data: torch.from_numpy(np.frombuffer(data, dtype=np.float32).copy()),
+                                   path_to_db=path_to_db,
+                                   max_entries_in_memory=max_entries_in_memory)
+
+    @staticmethod
+    def make_key(path_to_reference_audio):
+        """
+        Hash of the content of the audio file together with its sampling rate
+        """
+        return hash_file(path_to_reference_audio, extra=str(soundfile.info(path_to_reference_audio).samplerate))
+
+    def get(self, key):
+        """
+        Returns the embedding as a float tensor on the cpu or None if the key is unknown
+        """
+        return self.store.get(key)
+
+    def put(self, key, embedding):
+        self.store.put(key, embedding.detach().cpu().float())
+
+    def close(self):
+        self.store.close()
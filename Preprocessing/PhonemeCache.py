@@ -0,0 +1,74 @@
+import hashlib
+import struct
+
+import numpy as np
+import torch
+
+from Utility.KeyValueStore import KeyValueStore
+
+
+class PhonemeCache:
+
+    def __init__(self, path_to_db=None, max_entries_in_memory=20000):
+        """
+        Content addressed store for the results of the text frontend.
+
+        Every entry holds the phone string of a text and optionally
+        the articulatory feature matrix that belongs to it. Lookups
+        go to an in-process LRU first and then to an sqlite file on
+        disk, if a path is given, so that the results survive
+        between runs and can be shared between processes. The
+        version of the frontend is part of every key, and the
+        file only ever holds entries of the most recent version.
+        """
+        self.store = KeyValueStore(table="phonemes",
+                                   encode=encode_entry,
+                                   decode=decode_entry,
+                                   path_to_db=path_to_db,
+                                   max_entries_in_memory=max_entries_in_memory)
+
+    @staticmethod
+    def make_key(version, language, text, flags):
+        """
+        Hash of everything that influences the result of the frontend
+        """
+        return hashlib.sha1("\u0000".join([version, language, text, repr(flags)]).encode("utf8")).hexdigest()
+
+    def set_version(self, version):
+        """
+        Drops the entries on disk if they were made by a different version of the frontend
+        """
+        self.store.set_version(version)
+
+    def get(self, key):
+        """
+        Returns a tuple of the phone string and the feature tensor (which can be None) or None if the key is unknown
+        """
+        return self.store.get(key)
+
+    def put(self, key, phones, features=None):
+        if features is None:
+            # don't overwrite features that another caller might have stored already
+            self.store.put(key, (phones, None), overwrite=False)
+        else:
+            self.store.put(key, (phones, features.detach().cpu().float()))
+
+    def close(self):
+        self.store.close()
+
+
+def encode_entry(entry):
+    phones, features = entry
+    phones = phones.encode("utf8")
+    feature_size = 0 if features is None else features.shape[-1]
+    feature_bytes = b"" if features is None else features.numpy().astype(np.float32).tobytes()
+    return struct.pack("<II", len(phones), feature_size) + phones + feature_bytes
+
+
+def decode_entry(data):
+    phones_length, feature_size = struct.unpack_from("<II", data)
+    phones = bytes(data[8:8 + phones_length]).decode("utf8")
+    if feature_size == 0:
+        return phones, None
+    features = torch.from_numpy(np.frombuffer(data, dtype=np.float32, offset=8 + phones_length).reshape(-1, feature_size).copy())
+    return phones, features
@@ -1,9 +1,13 @@
+import time
+
 import soundfile as sf
 import torch
 import torch.multiprocessing
 import torch.multiprocessing
 from numpy import trim_zeros
 from speechbrain.pretrained import EncoderClassifier
+from torch.nn.utils.rnn import pad_sequence
+from tqdm import tqdm
 
 from Preprocessing.AudioPreprocessor import AudioPreprocessor
 
@@ -11,6 +15,7 @@ from Preprocessing.AudioPreprocessor import AudioPreprocessor
 class ProsodicConditionExtractor:
 
     def __init__(self, sr, device=torch.device("cpu")):
+        self.device = device
         self.ap = AudioPreprocessor(input_sr=sr, output_sr=16000, melspec_buckets=80, hop_length=256, n_fft=1024, cut_silence=False)
         # https://huggingface.co/speechbrain/spkrec-ecapa-voxceleb
         self.speaker_embedding_func_ecapa = EncoderClassifier.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
@@ -27,11 +32,71 @@ class ProsodicConditionExtractor:
         else:
             norm_wave = self.ap.audio_to_wave_tensor(normalize=True, audio=wave)
             norm_wave = torch.tensor(trim_zeros(norm_wave.numpy()))
-        spk_emb_ecapa = self.speaker_embedding_func_ecapa.encode_batch(wavs=norm_wave.unsqueeze(0)).squeeze()
-        spk_emb_xvector = self.speaker_embedding_func_xvector.encode_batch(wavs=norm_wave.unsqueeze(0)).squeeze()
-        combined_utt_condition = torch.cat([spk_emb_ecapa.cpu(),
-                                            spk_emb_xvector.cpu()], dim=0)
-        return combined_utt_condition
+        return embed_batch([norm_wave], [self.speaker_embedding_func_ecapa, self.speaker_embedding_func_xvector], device=self.device)[0]
+
+    def extract_conditions_from_reference_waves(self, waves, already_normalized=False, batch_size=16, verbose=True):
+        """
+        Batched version of extract_condition_from_reference_wave. Both
+        embeddings are computed from the same padded batch. Returns
+        the conditions in the order of the waves, with None in place
+        of the waves that don't produce a condition.
+        """
+        if already_normalized:
+            norm_waves = waves
+        else:
+            norm_waves = list()
+            for wave in waves:
+                norm_wave = self.ap.audio_to_wave_tensor(normalize=True, audio=wave)
+                norm_waves.append(torch.tensor(trim_zeros(norm_wave.numpy())))
+        return embed_in_batches(norm_waves,
+                                [self.speaker_embedding_func_ecapa, self.speaker_embedding_func_xvector],
+                                device=self.device,
+                                batch_size=batch_size,
+                                verbose=verbose)
+
+
+def embed_batch(waves, encoders, device="cpu"):
+    """
+    Pads the waves into a single batch, runs every encoder over it
+    and returns the concatenated embeddings of each wave.
+    """
+    lengths = torch.tensor([len(wave) for wave in waves], dtype=torch.float32)
+    wavs = pad_sequence([torch.as_tensor(wave, dtype=torch.float32) for wave in waves], batch_first=True).to(device)
+    wav_lens = (lengths / lengths.max()).to(device)
+    with torch.no_grad():
+        embeddings = [encoder.encode_batch(wavs=wavs, wav_lens=wav_lens).squeeze(1).cpu() for encoder in encoders]
+    return list(torch.cat(embeddings, dim=-1))
+
+
+def embed_in_batches(waves, encoders, device="cpu", batch_size=16, verbose=False):
+    """
+    Runs speechbrain encoders over many waves, batch_size at a time.
+    The waves are sorted by length first, so that little compute is
+    wasted on padding. If a batch fails, its waves are retried one
+    by one and the ones that still fail get None as their embedding.
+    """
+    embeddings = [None] * len(waves)
+    order = sorted(range(len(waves)), key=lambda index: len(waves[index]), reverse=True)
+    start_time = time.time()
+    for batch_start in tqdm(range(0, len(order), batch_size), disable=not verbose):
+        batch_indexes = order[batch_start:batch_start + batch_size]
+        try:
+            batch_embeddings = embed_batch([waves[index] for index in batch_indexes], encoders, device=device)
+        except RuntimeError:
+            # e.g. an audio without any voiced segments whatsoever
+            batch_embeddings = list()
+            for index in batch_indexes:
+                try:
+                    batch_embeddings.append(embed_batch([waves[index]], encoders, device=device)[0])
+                except RuntimeError:
+                    batch_embeddings.append(None)
+        for index, embedding in zip(batch_indexes, batch_embeddings):
+            embeddings[index] = embedding
+    if verbose and len(waves) > 0:
+        duration = time.time() - start_time
+        audio_duration = sum(len(wave) for wave in waves) / 16000
+        print(f"Embedded {len(waves)} waves in {round(duration, 2)} seconds ({round(len(waves) / duration, 2)} waves per second, {round(audio_duration / duration, 2)} seconds of audio per second).")
+    return embeddings
 
 
 if __name__ == '__main__':
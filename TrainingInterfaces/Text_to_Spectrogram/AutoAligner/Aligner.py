@@ -13,6 +13,7 @@ from torch.nn.utils.rnn import pack_padded_sequence
 from torch.nn.utils.rnn import pad_packed_sequence
 
 from Preprocessing.ArticulatoryCombinedTextFrontend import ArticulatoryCombinedTextFrontend
+from Utility.utils import make_pad_mask
 
 
 class BatchNormConv(nn.Module):
@@ -58,12 +59,14 @@ class Aligner(torch.nn.Module):
         self.proj = torch.nn.Linear(2 * lstm_dim, num_symbols)
         self.tf = ArticulatoryCombinedTextFrontend(language="en")
         self.ctc_loss = CTCLoss(blank=144, zero_infinity=True)
-        self.vector_to_id = dict()
-        for phone in self.tf.phone_to_vector:
-            self.vector_to_id[tuple(self.tf.phone_to_vector[phone])] = self.tf.phone_to_id[phone]
 
     def forward(self, x, lens=None):
+        if lens is not None:
+            pad_mask = make_pad_mask(lens, x[:, :, 0]).unsqueeze(-1)
         for conv in self.convs:
+            if lens is not None and isinstance(conv, BatchNormConv):
+                # after the batch norm the padding is no longer zero and would leak into the last frames of shorter items
+                x = x.masked_fill(pad_mask, 0.0)
             x = conv(x)
 
         if lens is not None:
@@ -99,10 +102,8 @@ class Aligner(torch.nn.Module):
     @torch.inference_mode()
     def inference(self, mel, tokens, save_img_for_debug=None, train=False, pathfinding="MAS", return_ctc=False):
         if not train:
-            tokens_indexed = list()  # first we need to convert the articulatory vectors to IDs, so we can apply dijkstra or viterbi
-            for vector in tokens:
-                tokens_indexed.append(self.vector_to_id[tuple(vector.cpu().detach().numpy().tolist())])
-            tokens = np.asarray(tokens_indexed)
+            # first we need to convert the articulatory vectors to IDs, so we can apply dijkstra or viterbi
+            tokens = self.tf.vectors_to_ids(tokens.detach()).numpy()
         else:
             tokens = tokens.cpu().detach().numpy()
 
@@ -113,18 +114,13 @@ class Aligner(torch.nn.Module):
         pred = pred.squeeze().cpu().detach().numpy()
         pred_max = pred[:, tokens]
         path_probs = 1. - pred_max
-        adj_matrix = to_adj_matrix(path_probs)
 
         if pathfinding == "MAS":
 
             alignment_matrix = binarize_alignment(pred_max)
 
             if save_img_for_debug is not None:
-                phones = list()
-                for index in tokens:
-                    for phone in self.tf.phone_to_id:
-                        if self.tf.phone_to_id[phone] == index:
-                            phones.append(phone)
+                phones = [self.tf.id_to_phone[index] for index in tokens]
                 fig, ax = plt.subplots(nrows=2, ncols=1, figsize=(10, 9))
 
                 ax[0].imshow(pred_max, interpolation='nearest', aspect='auto', origin="lower")
@@ -153,6 +149,7 @@ class Aligner(torch.nn.Module):
 
         elif pathfinding == "dijkstra":
 
+            adj_matrix = to_adj_matrix(path_probs)
             dist_matrix, predecessors, *_ = dijkstra(csgraph=adj_matrix,
                                                      directed=True,
                                                      indices=0,
@@ -180,11 +177,7 @@ class Aligner(torch.nn.Module):
 
             if save_img_for_debug is not None:
 
-                phones = list()
-                for index in tokens:
-                    for phone in self.tf.phone_to_id:
-                        if self.tf.phone_to_id[phone] == index:
-                            phones.append(phone)
+                phones = [self.tf.id_to_phone[index] for index in tokens]
                 fig, ax = plt.subplots(nrows=2, ncols=1, figsize=(10, 9))
 
                 ax[0].imshow(pred_max, interpolation='nearest', aspect='auto', origin="lower")
@@ -211,6 +204,37 @@ class Aligner(torch.nn.Module):
                 return path_plot, ctc_loss
             return path_plot
 
+    @torch.inference_mode()
+    def batch_inference(self, mels, mel_lens, tokens, token_lens):
+        """
+        Aligns a whole padded batch at once using MAS.
+
+        Args:
+            mels: padded batch of spectrograms (B, Tmax, n_mels)
+            mel_lens: amount of frames of each spectrogram (B,)
+            tokens: padded batch of phone IDs (B, Nmax)
+            token_lens: amount of phones in each sequence (B,)
+
+        Returns:
+            a list with the alignment matrix (frames x phones) of every item and a list with their CTC losses
+        """
+        pred = self(mels, mel_lens)
+        # same value as self.ctc_loss would give for each item on its own, since that averages over the target length
+        ctc_losses = torch.nn.functional.ctc_loss(pred.transpose(0, 1).log_softmax(2),
+                                                  tokens,
+                                                  mel_lens,
+                                                  token_lens,
+                                                  blank=self.ctc_loss.blank,
+                                                  reduction="none",
+                                                  zero_infinity=True) / token_lens.clamp(min=1)
+        pred = pred.cpu().detach().numpy()
+        tokens = tokens.cpu().numpy()
+        mel_lens = mel_lens.cpu().tolist()
+        token_lens = token_lens.cpu().tolist()
+        pred_max = np.take_along_axis(pred, tokens[:, None, :], axis=2)  # (B, Tmax, Nmax)
+        alignment_matrices = binarize_alignments(pred_max, mel_lens, token_lens)
+        return [np.ascontiguousarray(alignment_matrices[b, :mel_lens[b], :token_lens[b]]) for b in range(len(mel_lens))], ctc_losses.cpu().tolist()
+
 
 def binarize_alignment(alignment_prob):
     """
@@ -229,15 +253,12 @@ def binarize_alignment(alignment_prob):
     log_p = np.zeros_like(attn_map)
     log_p[0, :] = attn_map[0, :]
     prev_ind = np.zeros_like(attn_map, dtype=np.int64)
+    text_indexes = np.arange(attn_map.shape[1])
     for i in range(1, attn_map.shape[0]):
-        for j in range(attn_map.shape[1]):  # for each text dim
-            prev_log = log_p[i - 1, j]
-            prev_j = j
-            if j - 1 >= 0 and log_p[i - 1, j - 1] >= log_p[i - 1, j]:
-                prev_log = log_p[i - 1, j - 1]
-                prev_j = j - 1
-            log_p[i, j] = attn_map[i, j] + prev_log
-            prev_ind[i, j] = prev_j
+        # the recursion only runs along the mel axis, so all text positions of a frame can be handled at once
+        take_diagonal, prev_log = _mas_step(log_p[i - 1])
+        log_p[i] = attn_map[i] + prev_log
+        prev_ind[i] = np.where(take_diagonal, text_indexes - 1, text_indexes)
     # now backtrack
     curr_text_idx = attn_map.shape[1] - 1
     for i in range(attn_map.shape[0] - 1, -1, -1):
@@ -247,6 +268,54 @@ def binarize_alignment(alignment_prob):
     return opt
 
 
+def binarize_alignments(alignment_probs, mel_lens, text_lens):
+    """
+    Batched version of binarize_alignment for padded alignment matrices (B, mel, text).
+
+    Returns a padded array of the same shape, which holds the exact same
+    path for every item that binarize_alignment would have found on it.
+    """
+    batch_size, max_mel_len, max_text_len = alignment_probs.shape
+    opt = np.zeros_like(alignment_probs)
+    attn_map = np.full_like(alignment_probs, -np.inf)
+    for b in range(batch_size):
+        alignment_prob = alignment_probs[b, :mel_lens[b], :text_lens[b]]
+        alignment_prob = alignment_prob + (np.abs(alignment_prob).max() + 1.0)  # make all numbers positive and add an offset to avoid log of 0 later
+        attn_map[b, :mel_lens[b], :text_lens[b]] = np.log(alignment_prob)
+    attn_map[:, 0, 1:] = -np.inf
+    log_p = np.zeros_like(attn_map)
+    log_p[:, 0, :] = attn_map[:, 0, :]
+    prev_ind = np.zeros_like(attn_map, dtype=np.int64)
+    text_indexes = np.arange(max_text_len)
+    for i in range(1, max_mel_len):
+        # padded text positions are -inf and only ever feed positions to their right, which are padding as well
+        take_diagonal, prev_log = _mas_step(log_p[:, i - 1])
+        log_p[:, i] = attn_map[:, i] + prev_log
+        prev_ind[:, i] = np.where(take_diagonal, text_indexes - 1, text_indexes)
+    # now backtrack every item from its own last frame and token
+    for b in range(batch_size):
+        curr_text_idx = text_lens[b] - 1
+        for i in range(mel_lens[b] - 1, -1, -1):
+            opt[b, i, curr_text_idx] = 1
+            curr_text_idx = prev_ind[b, i, curr_text_idx]
+        opt[b, 0, curr_text_idx] = 1
+    return opt
+
+
+def _mas_step(prev_log_p):
+    """
+    For every text position of a frame, decide whether the best predecessor
+    is the previous token (diagonal step) or the same token. Ties go to the
+    previous token and the first token can only stay, as in the original loop.
+    """
+    diagonal_log_p = np.empty_like(prev_log_p)
+    diagonal_log_p[..., 0] = -np.inf
+    diagonal_log_p[..., 1:] = prev_log_p[..., :-1]
+    take_diagonal = diagonal_log_p >= prev_log_p
+    take_diagonal[..., 0] = False
+    return take_diagonal, np.where(take_diagonal, diagonal_log_p, prev_log_p)
+
+
 def to_node_index(i, j, cols):
     return cols * i + j
 
@@ -259,35 +328,12 @@ def to_adj_matrix(mat):
     rows = mat.shape[0]
     cols = mat.shape[1]
 
-    row_ind = []
-    col_ind = []
-    data = []
-
-    for i in range(rows):
-        for j in range(cols):
-
-            node = to_node_index(i, j, cols)
-
-            if j < cols - 1:
-                right_node = to_node_index(i, j + 1, cols)
-                weight_right = mat[i, j + 1]
-                row_ind.append(node)
-                col_ind.append(right_node)
-                data.append(weight_right)
-
-            if i < rows - 1 and j < cols:
-                bottom_node = to_node_index(i + 1, j, cols)
-                weight_bottom = mat[i + 1, j]
-                row_ind.append(node)
-                col_ind.append(bottom_node)
-                data.append(weight_bottom)
-
-            if i < rows - 1 and j < cols - 1:
-                bottom_right_node = to_node_index(i + 1, j + 1, cols)
-                weight_bottom_right = mat[i + 1, j + 1]
-                row_ind.append(node)
-                col_ind.append(bottom_right_node)
-                data.append(weight_bottom_right)
+    nodes = to_node_index(*np.indices((rows, cols)), cols)
+
+    # every node connects to its right, bottom and bottom right neighbour, weighted by the value at the neighbour
+    row_ind = np.concatenate([nodes[:, :-1].ravel(), nodes[:-1, :].ravel(), nodes[:-1, :-1].ravel()])
+    col_ind = np.concatenate([nodes[:, 1:].ravel(), nodes[1:, :].ravel(), nodes[1:, 1:].ravel()])
+    data = np.concatenate([mat[:, 1:].ravel(), mat[1:, :].ravel(), mat[1:, 1:].ravel()])
 
     adj_mat = coo_matrix((data, (row_ind, col_ind)), shape=(rows * cols, rows * cols))
     return adj_mat.tocsr()
@@ -1,22 +1,36 @@
 import os
+import queue
 import random
+import threading
 import warnings
 
 import soundfile as sf
 import torch
 from numpy import trim_zeros
 from speechbrain.pretrained import EncoderClassifier
-from torch.multiprocessing import Manager
 from torch.multiprocessing import Process
+from torch.multiprocessing import Queue
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
 from Preprocessing.ArticulatoryCombinedTextFrontend import ArticulatoryCombinedTextFrontend
 from Preprocessing.AudioPreprocessor import AudioPreprocessor
+from Preprocessing.ProsodicConditionExtractor import embed_in_batches
+from Utility.ShardedCache import ShardedCache
+from Utility.ShardedCache import ShardedCacheWriter
+from Utility.utils import hash_file
 
 
 FEATURE_SIZE: int = 88
 
+CACHE_FIELDS = {"text"             : "float32",
+                "text_len"         : "int64",
+                "speech"           : "float32",
+                "speech_len"       : "int64",
+                "tokens"           : "int64",
+                "wave"             : "float32",
+                "speaker_embedding": "float32"}
+
 
 class AlignerDataset(Dataset):
 
@@ -31,180 +45,409 @@ class AlignerDataset(Dataset):
                  rebuild_cache=False,
                  verbose=False,
                  device="cpu",
-                 phone_input=False):
+                 phone_input=False,
+                 update_cache=False):  # opt-in, since checking an existing cache for changes reads every file of the corpus
         os.makedirs(cache_dir, exist_ok=True)
-        if not os.path.exists(os.path.join(cache_dir, "aligner_train_cache.pt")) or rebuild_cache:
-            if cut_silences:
-                torch.set_num_threads(1)
-                torch.hub.load(repo_or_dir='snakers4/silero-vad',
-                               model='silero_vad',
-                               force_reload=False,
-                               onnx=False,
-                               verbose=False)  # download and cache for it to be loaded and used later
-                torch.set_grad_enabled(True)
-            resource_manager = Manager()
-            self.path_to_transcript_dict = resource_manager.dict(path_to_transcript_dict)
-            key_list = list(self.path_to_transcript_dict.keys())
-            with open(os.path.join(cache_dir, "files_used.txt"), encoding='utf8', mode="w") as files_used_note:
-                files_used_note.write(str(key_list))
-            random.shuffle(key_list)
-            # build cache
-            print("... building dataset cache ...")
-            self.datapoints = resource_manager.list()
-            # make processes
-            key_splits = list()
-            process_list = list()
-            for i in range(loading_processes):
-                key_splits.append(key_list[i * len(key_list) // loading_processes:(i + 1) * len(key_list) // loading_processes])
-            for key_split in key_splits:
-                process_list.append(
-                    Process(target=self.cache_builder_process,
-                            args=(key_split,
-                                  lang,
-                                  min_len_in_seconds,
-                                  max_len_in_seconds,
-                                  cut_silences,
-                                  verbose,
-                                  "cpu",
-                                  phone_input),
-                            daemon=True))
-                process_list[-1].start()
-            for process in process_list:
-                process.join()
-            self.datapoints = list(self.datapoints)
-            tensored_datapoints = list()
-            # we had to turn all of the tensors to numpy arrays to avoid shared memory
-            # issues. Now that the multi-processing is over, we can convert them back
-            # to tensors to save on conversions in the future.
-            print("Converting into convenient format...")
-            norm_waves = list()
-            for datapoint in tqdm(self.datapoints):
-                tensored_datapoints.append([torch.Tensor(datapoint[0]),
-                                            torch.LongTensor(datapoint[1]),
-                                            torch.Tensor(datapoint[2]),
-                                            torch.LongTensor(datapoint[3])])
-                norm_waves.append(torch.Tensor(datapoint[-1]))
-
-            self.datapoints = tensored_datapoints
-
-            pop_indexes = list()
-            for index, el in enumerate(self.datapoints):
-                try:
-                    if len(el[0][0]) != FEATURE_SIZE:
-                        pop_indexes.append(index)
-                except TypeError:
-                    pop_indexes.append(index)
-            for pop_index in sorted(pop_indexes, reverse=True):
-                print(f"There seems to be a problem in the transcriptions. Deleting datapoint {pop_index}.")
-                self.datapoints.pop(pop_index)
-
-            # add speaker embeddings
-            self.speaker_embeddings = list()
-            speaker_embedding_func_ecapa = EncoderClassifier.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
-                                                                          run_opts={"device": str(device)},
-                                                                          savedir="Models/SpeakerEmbedding/speechbrain_speaker_embedding_ecapa")
-            with torch.no_grad():
-                for wave in tqdm(norm_waves):
-                    self.speaker_embeddings.append(speaker_embedding_func_ecapa.encode_batch(wavs=wave.to(device).unsqueeze(0)).squeeze().cpu())
-
-            # save to cache
-            torch.save((self.datapoints, norm_waves, self.speaker_embeddings), os.path.join(cache_dir, "aligner_train_cache.pt"))
-        else:
-            # just load the datapoints from cache
-            self.datapoints = torch.load(os.path.join(cache_dir, "aligner_train_cache.pt"), map_location='cpu')
-            if len(self.datapoints) == 2:
-                # speaker embeddings are still missing, have to add them here
-                wave_datapoints = self.datapoints[1]
-                self.datapoints = self.datapoints[0]
-                self.speaker_embeddings = list()
-                speaker_embedding_func_ecapa = EncoderClassifier.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
-                                                                              run_opts={"device": str(device)},
-                                                                              savedir="Models/SpeakerEmbedding/speechbrain_speaker_embedding_ecapa")
-                with torch.no_grad():
-                    for wave in tqdm(wave_datapoints):
-                        self.speaker_embeddings.append(speaker_embedding_func_ecapa.encode_batch(wavs=wave.to(device).unsqueeze(0)).squeeze().cpu())
-                torch.save((self.datapoints, wave_datapoints, self.speaker_embeddings), os.path.join(cache_dir, "aligner_train_cache.pt"))
+        cache_path = os.path.join(cache_dir, "aligner_train_cache")
+        if not rebuild_cache and not ShardedCache.exists(cache_path) and os.path.exists(os.path.join(cache_dir, "aligner_train_cache.pt")):
+            convert_legacy_cache(cache_dir, lang=lang, device=device)
+        settings = {"lang"        : lang,
+                    "min_len"     : min_len_in_seconds,
+                    "max_len"     : max_len_in_seconds,
+                    "cut_silences": cut_silences,
+                    "phone_input" : phone_input}
+        old_cache = None
+        known_files = dict()
+        if ShardedCache.exists(cache_path) and not rebuild_cache:
+            old_cache = ShardedCache(cache_path)
+            if old_cache.keys is None:
+                if update_cache:
+                    print(f"The Aligner dataset in {cache_dir} does not know which files its datapoints come from, so it can't be updated. Rebuild it once to enable updates.")
+                update_cache = False
+            elif update_cache and old_cache.metadata.get("settings") != settings:
+                print(f"The Aligner dataset in {cache_dir} was built with different settings, so it has to be rebuilt.")
+                old_cache = None
             else:
-                self.speaker_embeddings = self.datapoints[2]
-                self.datapoints = self.datapoints[0]
+                # files that were deliberately left out don't have to be looked at again as long as they don't change
+                known_files = {**old_cache.metadata.get("excluded", dict()), **old_cache.metadata.get("files", dict())}
+        if old_cache is None or update_cache:
+            files = describe_files(path_to_transcript_dict, known_files)
+            paths_to_process = [path for path in files if path not in known_files or known_files[path]["hash"] != files[path]["hash"]]
+            deleted_paths = [path for path in known_files if path not in files]
+            if old_cache is None or len(paths_to_process) > 0 or len(deleted_paths) > 0:
+                if old_cache is not None:
+                    print(f"Updating the Aligner dataset in {cache_dir}: {len(paths_to_process)} new or changed files, {len(deleted_paths)} deleted files.")
+                self._update_cache(cache_path=cache_path,
+                                   old_cache=old_cache,
+                                   path_to_transcript_dict=path_to_transcript_dict,
+                                   paths_to_process=paths_to_process,
+                                   metadata={"settings": settings, "files": files},
+                                   lang=lang,
+                                   loading_processes=loading_processes,
+                                   min_len_in_seconds=min_len_in_seconds,
+                                   max_len_in_seconds=max_len_in_seconds,
+                                   cut_silences=cut_silences,
+                                   verbose=verbose,
+                                   device=device,
+                                   phone_input=phone_input)
+                with open(os.path.join(cache_dir, "files_used.txt"), encoding='utf8', mode="w") as files_used_note:
+                    files_used_note.write(str(list(files.keys())))
 
+        self.cache = ShardedCache(cache_path)
         self.tf = ArticulatoryCombinedTextFrontend(language=lang, use_word_boundaries=True)
-        print(f"Prepared an Aligner dataset with {len(self.datapoints)} datapoints in {cache_dir}.")
+        print(f"Prepared an Aligner dataset with {len(self.cache)} datapoints in {cache_dir}.")
+
+    def _update_cache(self,
+                      cache_path,
+                      old_cache,
+                      path_to_transcript_dict,
+                      paths_to_process,
+                      metadata,
+                      lang,
+                      loading_processes,
+                      min_len_in_seconds,
+                      max_len_in_seconds,
+                      cut_silences,
+                      verbose,
+                      device,
+                      phone_input):
+        """
+        Processes the given files and writes them to the cache
+        together with those datapoints of the old cache whose
+        files are still there and haven't changed.
+
+        Only the files whose datapoints end up in the cache are
+        recorded in its metadata, together with the files that
+        were looked at and deliberately left out, e.g. because of
+        their duration. Anything else is processed again by the
+        next update.
+        """
+        processed_paths = set(paths_to_process)
+        handled_paths = set()
+        with ShardedCacheWriter(cache_path, CACHE_FIELDS, metadata=metadata) as writer:
+            # keep what is still valid from before
+            if old_cache is not None:
+                for index, path in enumerate(old_cache.keys):
+                    if path in metadata["files"] and path not in processed_paths:
+                        writer.append(old_cache[index], key=path)
+            if len(paths_to_process) > 0:
+                self._write_new_files(writer=writer,
+                                      handled_paths=handled_paths,
+                                      path_to_transcript_dict=path_to_transcript_dict,
+                                      paths_to_process=paths_to_process,
+                                      lang=lang,
+                                      loading_processes=loading_processes,
+                                      min_len_in_seconds=min_len_in_seconds,
+                                      max_len_in_seconds=max_len_in_seconds,
+                                      cut_silences=cut_silences,
+                                      verbose=verbose,
+                                      device=device,
+                                      phone_input=phone_input)
+            written_paths = set(writer.keys)
+            all_files = metadata["files"]
+            writer.metadata["files"] = {path: all_files[path] for path in all_files if path in written_paths}
+            # files that weren't processed this time and aren't in the cache were left out by an earlier update
+            writer.metadata["excluded"] = {path: all_files[path] for path in all_files
+                                           if path not in written_paths and (path in handled_paths or path not in processed_paths)}
+
+    def _write_new_files(self,
+                         writer,
+                         handled_paths,
+                         path_to_transcript_dict,
+                         paths_to_process,
+                         lang,
+                         loading_processes,
+                         min_len_in_seconds,
+                         max_len_in_seconds,
+                         cut_silences,
+                         verbose,
+                         device,
+                         phone_input):
+        """
+        Turns the given files into datapoints and appends them to the writer.
+        Every file that a worker has looked at is added to handled_paths.
+        """
+        if cut_silences:
+            torch.set_num_threads(1)
+            torch.hub.load(repo_or_dir='snakers4/silero-vad',
+                           model='silero_vad',
+                           force_reload=False,
+                           onnx=False,
+                           verbose=False)  # download and cache for it to be loaded and used later
+            torch.set_grad_enabled(True)
+        speaker_embedding_func_ecapa = EncoderClassifier.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
+                                                                      run_opts={"device": str(device)},
+                                                                      savedir="Models/SpeakerEmbedding/speechbrain_speaker_embedding_ecapa")
+        if phone_input:
+            path_to_phones_dict = {path: path_to_transcript_dict[path] for path in paths_to_process}
+        else:
+            # one call to the g2p for the whole corpus, the audio is then spread over the workers in small chunks
+            print("... phonemizing transcripts ...")
+            tf = ArticulatoryCombinedTextFrontend(language=lang, use_word_boundaries=False)
+            paths_with_transcript = [path for path in paths_to_process if path_to_transcript_dict[path].strip() != ""]
+            path_to_phones_dict = {path: "" for path in paths_to_process}
+            path_to_phones_dict.update(zip(paths_with_transcript, tf.get_phone_strings([path_to_transcript_dict[path] for path in paths_with_transcript],
+                                                                                      n_jobs=loading_processes)))
+        # build cache
+        print("... building dataset cache ...")
+        datapoints = list()
+        for chunk_paths, chunk_datapoints in self._process_in_parallel(path_to_phones_dict=path_to_phones_dict,
+                                                                       paths=paths_to_process,
+                                                                       loading_processes=loading_processes,
+                                                                       worker_args=(lang,
+                                                                                    min_len_in_seconds,
+                                                                                    max_len_in_seconds,
+                                                                                    cut_silences,
+                                                                                    verbose,
+                                                                                    "cpu")):
+            handled_paths.update(chunk_paths)
+            for datapoint in chunk_datapoints:
+                try:
+                    if len(datapoint[0][0]) != FEATURE_SIZE:
+                        print(f"There seems to be a problem in the transcription of {datapoint[5]}. Skipping it.")
+                        continue
+                except TypeError:
+                    print(f"There seems to be a problem in the transcription of {datapoint[5]}. Skipping it.")
+                    continue
+                datapoints.append(datapoint)
+                if len(datapoints) >= 128:
+                    self._write_datapoints(writer, datapoints, speaker_embedding_func_ecapa, device)
+                    datapoints = list()
+        self._write_datapoints(writer, datapoints, speaker_embedding_func_ecapa, device)
+
+    @staticmethod
+    def _write_datapoints(writer, datapoints, speaker_embedding_func, device):
+        # the workers send numpy arrays to avoid shared memory issues, so we convert them back to tensors here
+        norm_waves = [torch.Tensor(datapoint[-1]) for datapoint in datapoints]
+        speaker_embeddings = compute_speaker_embeddings(norm_waves, device=device, speaker_embedding_func=speaker_embedding_func)
+        for datapoint, wave, speaker_embedding in zip(datapoints, norm_waves, speaker_embeddings):
+            if speaker_embedding is None:
+                print(f"Skipping {datapoint[5]}, because no speaker embedding could be computed for it.")
+                continue
+            writer.append(to_cache_item([torch.Tensor(datapoint[0]),
+                                         torch.LongTensor(datapoint[1]),
+                                         torch.Tensor(datapoint[2]),
+                                         torch.LongTensor(datapoint[3]),
+                                         torch.LongTensor(datapoint[4])], wave, speaker_embedding), key=datapoint[5])
+
+    def _process_in_parallel(self, path_to_phones_dict, paths, loading_processes, worker_args, chunk_size=16):
+        """
+        Streams the results of the given files out of a pool of
+        worker processes, as tuples of the paths of a chunk and the
+        datapoints made from them. The workers take small chunks of
+        files from a bounded queue whenever they are done with their
+        previous chunk, so a few long files don't hold up everyone
+        else, and the bounded queues make sure that neither the
+        work nor the results pile up in memory. If a worker dies,
+        the others are stopped and an error is raised, since the
+        files it was working on would otherwise just be missing.
+        """
+        key_list = list(paths)
+        random.shuffle(key_list)
+        loading_processes = max(1, min(loading_processes, (len(key_list) + chunk_size - 1) // chunk_size))
+        task_queue = Queue(maxsize=2 * loading_processes)
+        result_queue = Queue(maxsize=4 * loading_processes)
+        stop_feeding = threading.Event()
+
+        def feed_tasks():
+            tasks = [[(path, path_to_phones_dict[path]) for path in key_list[chunk_start:chunk_start + chunk_size]]
+                     for chunk_start in range(0, len(key_list), chunk_size)]
+            for task in tasks + [None] * loading_processes:
+                # never block for good, the workers that should take the task might be gone
+                while not stop_feeding.is_set():
+                    try:
+                        task_queue.put(task, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+
+        process_list = list()
+        try:
+            for _ in range(loading_processes):
+                process_list.append(Process(target=self.cache_builder_process, args=(task_queue, result_queue, *worker_args), daemon=True))
+                process_list[-1].start()
+            # the feeder thread is only started once all processes are forked
+            threading.Thread(target=feed_tasks, daemon=True).start()
+            finished_processes = 0
+            with tqdm(total=len(key_list)) as progress_bar:
+                while finished_processes < loading_processes:
+                    if any(process.exitcode not in (None, 0) for process in process_list):
+                        raise RuntimeError("A worker process building the Aligner dataset died, see its error above.")
+                    try:
+                        result = result_queue.get(timeout=1)
+                    except queue.Empty:
+                        continue
+                    if result is None:
+                        finished_processes += 1
+                        continue
+                    chunk_paths, chunk_datapoints = result
+                    progress_bar.update(len(chunk_paths))
+                    yield chunk_paths, chunk_datapoints
+            for process in process_list:
+                process.join()
+            if any(process.exitcode != 0 for process in process_list):
+                raise RuntimeError("A worker process building the Aligner dataset died, see its error above.")
+        finally:
+            stop_feeding.set()
+            for process in process_list:
+                if process.is_alive():
+                    process.terminate()
 
-    def cache_builder_process(self,
-                              path_list,
+    @staticmethod
+    def cache_builder_process(task_queue,
+                              result_queue,
                               lang,
                               min_len,
                               max_len,
                               cut_silences,
                               verbose,
-                              device,
-                              phone_input):
-        process_internal_dataset_chunk = list()
-        tf = ArticulatoryCombinedTextFrontend(language=lang, use_word_boundaries=False)
-        _, sr = sf.read(path_list[0])
-        ap = AudioPreprocessor(input_sr=sr, output_sr=16000, melspec_buckets=80, hop_length=256, n_fft=1024, cut_silence=cut_silences, device=device)
-
-        for path in tqdm(path_list):
-            if self.path_to_transcript_dict[path].strip() == "":
-                continue
+                              device):
+        try:
+            tf = ArticulatoryCombinedTextFrontend(language=lang, use_word_boundaries=False)
+            ap = None
+            for chunk in iter(task_queue.get, None):
+                process_internal_dataset_chunk = list()
+                # the transcripts arrive already phonemized
+                phone_strings = dict(chunk)
 
-            wave, sr = sf.read(path)
-            dur_in_seconds = len(wave) / sr
-            if not (min_len <= dur_in_seconds <= max_len):
-                if verbose:
-                    print(f"Excluding {path} because of its duration of {round(dur_in_seconds, 2)} seconds.")
-                continue
-            try:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")  # otherwise we get tons of warnings about an RNN not being in contiguous chunks
-                    norm_wave = ap.audio_to_wave_tensor(normalize=True, audio=wave)
-            except ValueError:
-                continue
-            dur_in_seconds = len(norm_wave) / 16000
-            if not (min_len <= dur_in_seconds <= max_len):
-                if verbose:
-                    print(f"Excluding {path} because of its duration of {round(dur_in_seconds, 2)} seconds.")
-                continue
-            norm_wave = torch.tensor(trim_zeros(norm_wave.numpy()))
-            # raw audio preprocessing is done
-            transcript = self.path_to_transcript_dict[path]
-            try:
-                cached_text = tf.string_to_tensor(transcript, handle_missing=False, input_phonemes=phone_input).squeeze(0).cpu().numpy()
-            except KeyError:
-                tf.string_to_tensor(transcript, handle_missing=True, input_phonemes=phone_input).squeeze(0).cpu().numpy()
-                continue  # we skip sentences with unknown symbols
-            try:
-                if len(cached_text[0]) != FEATURE_SIZE:
-                    print(f"There seems to be a problem with the following transcription: {transcript} ({len(cached_text[0])})")
-                    continue
-            except TypeError:
-                print(f"There seems to be a problem with the following transcription: {transcript} {type(transcript)}")
-                continue
-            cached_text_len = torch.LongTensor([len(cached_text)]).numpy()
-            cached_speech = ap.audio_to_mel_spec_tensor(audio=norm_wave, normalize=False, explicit_sampling_rate=16000).transpose(0, 1).cpu().numpy()
-            cached_speech_len = torch.LongTensor([len(cached_speech)]).numpy()
-            process_internal_dataset_chunk.append([cached_text,
-                                                   cached_text_len,
-                                                   cached_speech,
-                                                   cached_speech_len,
-                                                   norm_wave.cpu().detach().numpy()])
-        self.datapoints += process_internal_dataset_chunk
+                for path in phone_strings:
+                    if phone_strings[path].strip() == "":
+                        continue
+
+                    wave, sr = sf.read(path)
+                    if ap is None or ap.sr != sr:
+                        ap = AudioPreprocessor(input_sr=sr, output_sr=16000, melspec_buckets=80, hop_length=256, n_fft=1024, cut_silence=cut_silences, device=device)
+                    dur_in_seconds = len(wave) / sr
+                    if not (min_len <= dur_in_seconds <= max_len):
+                        if verbose:
+                            print(f"Excluding {path} because of its duration of {round(dur_in_seconds, 2)} seconds.")
+                        continue
+                    try:
+                        with warnings.catch_warnings():
+                            warnings.simplefilter("ignore")  # otherwise we get tons of warnings about an RNN not being in contiguous chunks
+                            norm_wave = ap.audio_to_wave_tensor(normalize=True, audio=wave)
+                    except ValueError:
+                        continue
+                    dur_in_seconds = len(norm_wave) / 16000
+                    if not (min_len <= dur_in_seconds <= max_len):
+                        if verbose:
+                            print(f"Excluding {path} because of its duration of {round(dur_in_seconds, 2)} seconds.")
+                        continue
+                    norm_wave = torch.tensor(trim_zeros(norm_wave.numpy()))
+                    # raw audio preprocessing is done
+                    transcript = phone_strings[path]
+                    try:
+                        cached_text = tf.string_to_tensor(phone_strings[path], handle_missing=False, input_phonemes=True).squeeze(0).cpu().numpy()
+                    except KeyError:
+                        tf.string_to_tensor(phone_strings[path], handle_missing=True, input_phonemes=True).squeeze(0).cpu().numpy()
+                        continue  # we skip sentences with unknown symbols
+                    try:
+                        if len(cached_text[0]) != FEATURE_SIZE:
+                            print(f"There seems to be a problem with the following transcription: {transcript} ({len(cached_text[0])})")
+                            continue
+                    except TypeError:
+                        print(f"There seems to be a problem with the following transcription: {transcript} {type(transcript)}")
+                        continue
+                    cached_tokens = tf.phones_to_ids(phone_strings[path], handle_missing=False).numpy()
+                    cached_text_len = torch.LongTensor([len(cached_text)]).numpy()
+                    cached_speech = ap.audio_to_mel_spec_tensor(audio=norm_wave, normalize=False, explicit_sampling_rate=16000).transpose(0, 1).cpu().numpy()
+                    cached_speech_len = torch.LongTensor([len(cached_speech)]).numpy()
+                    process_internal_dataset_chunk.append([cached_text,
+                                                           cached_text_len,
+                                                           cached_speech,
+                                                           cached_speech_len,
+                                                           cached_tokens,
+                                                           path,
+                                                           norm_wave.cpu().detach().numpy()])
+                result_queue.put(([path for path, _ in chunk], process_internal_dataset_chunk))
+        finally:
+            # always sign off, otherwise the consumer would wait for this worker forever
+            result_queue.put(None)
 
     def __getitem__(self, index):
-        text_vector = self.datapoints[index][0]
-        tokens = list()
-        for vector in text_vector:
-            for phone in self.tf.phone_to_vector:
-                if vector.numpy().tolist() == self.tf.phone_to_vector[phone]:
-                    tokens.append(self.tf.phone_to_id[phone])
-                    # this is terribly inefficient, but it's good enough for testing for now.
-        tokens = torch.LongTensor(tokens)
-        return tokens, \
-               self.datapoints[index][1], \
-               self.datapoints[index][2], \
-               self.datapoints[index][3], \
-               self.speaker_embeddings[index]
+        return self.cache.get(index, "tokens", copy=False), \
+               self.cache.get(index, "text_len", copy=False), \
+               self.cache.get(index, "speech", copy=False), \
+               self.cache.get(index, "speech_len", copy=False), \
+               self.cache.get(index, "speaker_embedding", copy=False)
 
     def __len__(self):
-        return len(self.datapoints)
+        return len(self.cache)
+
+
+def compute_speaker_embeddings(waves, device="cpu", speaker_embedding_func=None, batch_size=16, verbose=False):
+    """
+    ECAPA embeddings of the waves, computed in padded batches. Waves that can't be embedded get None.
+    """
+    if speaker_embedding_func is None:
+        speaker_embedding_func = EncoderClassifier.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
+                                                                run_opts={"device": str(device)},
+                                                                savedir="Models/SpeakerEmbedding/speechbrain_speaker_embedding_ecapa")
+    return embed_in_batches(waves, [speaker_embedding_func], device=device, batch_size=batch_size, verbose=verbose)
+
+
+def describe_files(path_to_transcript_dict, known_files):
+    """
+    Size, modification time and content hash (which includes the
+    transcript) of every file. Files whose size and modification
+    time are unchanged keep the hash they had before, so that
+    only new or touched files have to be read.
+    """
+    files = dict()
+    for path in tqdm(path_to_transcript_dict, desc="Checking files"):
+        stat = os.stat(path)
+        known = known_files.get(path)
+        if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns and known["transcript"] == path_to_transcript_dict[path]:
+            files[path] = known
+        else:
+            files[path] = {"size"      : stat.st_size,
+                           "mtime"     : stat.st_mtime_ns,
+                           "transcript": path_to_transcript_dict[path],
+                           "hash"      : hash_file(path, extra=path_to_transcript_dict[path])}
+    return files
+
+
+def to_cache_item(datapoint, wave, speaker_embedding):
+    """
+    datapoints hold text, text length, speech, speech length and tokens, like the ones the cache builder produces
+    """
+    return {"text"             : datapoint[0],
+            "text_len"         : datapoint[1],
+            "speech"           : datapoint[2],
+            "speech_len"       : datapoint[3],
+            "tokens"           : datapoint[4],
+            "wave"             : wave,
+            "speaker_embedding": speaker_embedding}
+
+
+def convert_legacy_cache(cache_dir, lang="en", device="cpu"):
+    """
+    Converts an aligner_train_cache.pt from before the sharded
+    format into the sharded format. Caches without speaker
+    embeddings or phone IDs get them added on the way. Caches
+    that don't even contain the waves can't be converted and
+    have to be rebuilt, in which case False is returned.
+    """
+    legacy_cache = torch.load(os.path.join(cache_dir, "aligner_train_cache.pt"), map_location='cpu')
+    if not isinstance(legacy_cache, tuple):
+        print(f"The Aligner dataset in {cache_dir} is too old to be converted, since it does not contain the preprocessed waves.")
+        return False
+    print(f"Converting the Aligner dataset in {cache_dir} into the sharded format...")
+    datapoints = legacy_cache[0]
+    waves = legacy_cache[1]
+    if len(legacy_cache) == 2:
+        # speaker embeddings are still missing, have to add them here
+        speaker_embeddings = compute_speaker_embeddings(waves, device=device, verbose=True)
+    else:
+        speaker_embeddings = legacy_cache[2]
+    if len(datapoints) > 0 and len(datapoints[0]) < 5:
+        # caches from before the phone IDs were stored alongside the vectors
+        tf = ArticulatoryCombinedTextFrontend(language=lang)
+        datapoints = [list(datapoint) + [tf.vectors_to_ids(datapoint[0])] for datapoint in datapoints]
+    with ShardedCacheWriter(os.path.join(cache_dir, "aligner_train_cache"), CACHE_FIELDS) as writer:
+        for datapoint, wave, speaker_embedding in zip(datapoints, waves, speaker_embeddings):
+            if speaker_embedding is None:
+                print("Skipping a datapoint that no speaker embedding could be computed for.")
+                continue
+            writer.append(to_cache_item(datapoint, wave, speaker_embedding))
+    return True
@@ -6,6 +6,9 @@ import matplotlib.pyplot as plt
 
 import torch
 
+from Utility.utils import make_non_pad_mask
+from Utility.utils import make_pad_mask
+
 
 class DurationCalculator(torch.nn.Module):
 
@@ -27,5 +30,18 @@ class DurationCalculator(torch.nn.Module):
             plt.savefig(vis)
             plt.close()
         # calculate duration from 2d alignment matrix
-        durations = torch.stack([att_ws.argmax(-1).eq(i).sum() for i in range(att_ws.shape[1])])
+        durations = torch.bincount(att_ws.argmax(-1), minlength=att_ws.shape[1])
         return durations.view(-1) * self.reduction_factor
+
+    @torch.no_grad()
+    def batch_forward(self, att_ws, mel_lens, text_lens):
+        """
+        Convert a padded batch of alignment matrices (B, Tmax, Nmax) to a padded batch of durations (B, Nmax).
+        """
+        text_pad_mask = make_pad_mask(text_lens, device=att_ws.device).unsqueeze(1)  # (B, 1, Nmax)
+        # padded tokens must never be picked, padded frames must not be counted
+        token_of_frame = att_ws.float().masked_fill(text_pad_mask, float("-inf")).argmax(-1)  # (B, Tmax)
+        frame_is_valid = make_non_pad_mask(mel_lens, xs=token_of_frame).long()
+        durations = torch.zeros(att_ws.shape[0], att_ws.shape[2], dtype=torch.long, device=att_ws.device)
+        durations.scatter_add_(1, token_of_frame, frame_is_valid)
+        return durations * self.reduction_factor
@@ -6,6 +6,7 @@ import torch
 import torch.nn.functional as F
 
 from Layers.STFT import STFT
+from Utility.utils import average_by_duration
 from Utility.utils import pad_list
 
 
@@ -58,7 +59,7 @@ class EnergyCalculator(torch.nn.Module):
 
         # (Optional): Average by duration to calculate token-wise energy
         if self.use_token_averaged_energy:
-            energy = [self._average_by_duration(e[:el].view(-1), d) for e, el, d in zip(energy, energy_lengths, durations)]
+            energy = self._average_by_duration_batch([e[:el].view(-1) for e, el in zip(energy, energy_lengths)], durations)
             energy_lengths = durations_lengths
 
         # Padding
@@ -72,10 +73,15 @@ class EnergyCalculator(torch.nn.Module):
         return energy.unsqueeze(-1), energy_lengths
 
     def _average_by_duration(self, x, d):
-        assert 0 <= len(x) - d.sum() < self.reduction_factor
-        d_cumsum = F.pad(d.cumsum(dim=0), (1, 0))
-        x_avg = [x[start:end].mean() if len(x[start:end]) != 0 else x.new_tensor(0.0) for start, end in zip(d_cumsum[:-1], d_cumsum[1:])]
-        return torch.stack(x_avg)
+        return self._average_by_duration_batch([x], d.unsqueeze(0))[0]
+
+    def _average_by_duration_batch(self, xs, ds):
+        """
+        xs is a list of frame level energy sequences, ds the padded batch of their durations
+        """
+        for x, d in zip(xs, ds):
+            assert 0 <= len(x) - d.sum() < self.reduction_factor
+        return average_by_duration(pad_list(xs, 0.0), ds)
 
     @staticmethod
     def _adjust_num_frames(x, num_frames):
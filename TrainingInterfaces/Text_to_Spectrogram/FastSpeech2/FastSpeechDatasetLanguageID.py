@@ -1,7 +1,10 @@
 import os
 import statistics
+import time
 
+import numpy as np
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
@@ -12,6 +15,18 @@ from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.AlignerDataset import Al
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.DurationCalculator import DurationCalculator
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.EnergyCalculator import EnergyCalculator
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.PitchCalculator import Dio
+from Utility.ShardedCache import ShardedCache
+from Utility.ShardedCache import ShardedCacheWriter
+
+CACHE_FIELDS = {"text"               : "float32",
+                "text_len"           : "int64",
+                "speech"             : "float32",
+                "speech_len"         : "int64",
+                "durations"          : "int64",
+                "energy"             : "float32",
+                "pitch"              : "float32",
+                "utterance_condition": "float32",
+                "ctc_loss"           : "float32"}
 
 
 class FastSpeechDataset(Dataset):
@@ -29,11 +44,26 @@ class FastSpeechDataset(Dataset):
                  device=torch.device("cpu"),
                  rebuild_cache=False,
                  ctc_selection=True,
-                 save_imgs=False):
+                 save_imgs=False,
+                 aligner_batch_size=32,
+                 pitch_extraction_workers=4,
+                 update_cache=False):  # opt-in, since checking an existing cache for changes reads every file of the corpus
         self.cache_dir = cache_dir
         os.makedirs(cache_dir, exist_ok=True)
-        if not os.path.exists(os.path.join(cache_dir, "fast_train_cache.pt")) or rebuild_cache:
-            if not os.path.exists(os.path.join(cache_dir, "aligner_train_cache.pt")) or rebuild_cache:
+        self.cache_path = os.path.join(cache_dir, "fast_train_cache")
+        if not rebuild_cache and not ShardedCache.exists(self.cache_path) and os.path.exists(os.path.join(cache_dir, "fast_train_cache.pt")):
+            convert_legacy_cache(cache_dir)
+        old_cache = None
+        if ShardedCache.exists(self.cache_path) and not rebuild_cache:
+            old_cache = ShardedCache(self.cache_path)
+            if old_cache.keys is None:
+                if update_cache:
+                    print(f"The FastSpeech dataset in {cache_dir} does not know which files its datapoints come from, so it can't be updated. Rebuild it once to enable updates.")
+                update_cache = False
+        if old_cache is None or update_cache:
+            aligner_cache_path = os.path.join(cache_dir, "aligner_train_cache")
+            # the Aligner dataset converts legacy caches on its own, rebuilds them if they are too old to be converted and takes care of its own updates
+            if not ShardedCache.exists(aligner_cache_path) or rebuild_cache or update_cache:
                 AlignerDataset(path_to_transcript_dict=path_to_transcript_dict,
                                cache_dir=cache_dir,
                                lang=lang,
@@ -42,30 +72,66 @@ class FastSpeechDataset(Dataset):
                                max_len_in_seconds=max_len_in_seconds,
                                cut_silences=cut_silence,
                                rebuild_cache=rebuild_cache,
-                               device=device)
-            datapoints = torch.load(os.path.join(cache_dir, "aligner_train_cache.pt"), map_location='cpu')
+                               device=device,
+                               update_cache=update_cache)
             # we use the aligner dataset as basis and augment it to contain the additional information we need for fastspeech.
-            if not isinstance(datapoints, tuple):  # check for backwards compatibility
-                print(f"It seems like the Aligner dataset in {cache_dir} is not a tuple. Regenerating it, since we need the preprocessed waves.")
-                AlignerDataset(path_to_transcript_dict=path_to_transcript_dict,
-                               cache_dir=cache_dir,
-                               lang=lang,
-                               loading_processes=loading_processes,
+            dataset = ShardedCache(aligner_cache_path)
+            self._update_cache(dataset=dataset,
+                               old_cache=old_cache,
+                               acoustic_checkpoint_path=acoustic_checkpoint_path,
                                min_len_in_seconds=min_len_in_seconds,
-                               max_len_in_seconds=max_len_in_seconds,
-                               cut_silences=cut_silence,
-                               rebuild_cache=True)
-                datapoints = torch.load(os.path.join(cache_dir, "aligner_train_cache.pt"), map_location='cpu')
-            dataset = datapoints[0]
-            norm_waves = datapoints[1]
+                               reduction_factor=reduction_factor,
+                               device=device,
+                               ctc_selection=ctc_selection,
+                               save_imgs=save_imgs,
+                               aligner_batch_size=aligner_batch_size,
+                               pitch_extraction_workers=pitch_extraction_workers)
+
+        self.cache = ShardedCache(self.cache_path)
+        self.indexes = self._select_by_ctc(self.cache, ctc_selection)
+        self.language_id = get_language_id(lang)
+        print(f"Prepared a FastSpeech dataset with {len(self.indexes)} datapoints in {cache_dir}.")
+
+    def _update_cache(self,
+                      dataset,
+                      old_cache,
+                      acoustic_checkpoint_path,
+                      min_len_in_seconds,
+                      reduction_factor,
+                      device,
+                      ctc_selection,
+                      save_imgs,
+                      aligner_batch_size,
+                      pitch_extraction_workers):
+        """
+        Processes the datapoints of the Aligner dataset that are
+        new or whose files have changed and writes them to the
+        cache together with the still valid datapoints of the old
+        cache. Datapoints of files that are gone are dropped.
+        """
+        keys = dataset.keys if dataset.keys is not None else [None] * len(dataset)
+        aligner_files = dataset.metadata.get("files", dict())
+        current_files = {key: aligner_files[key]["hash"] for key in keys if key is not None and key in aligner_files}
+        processed_files = old_cache.metadata.get("processed", dict()) if old_cache is not None else dict()
+        indexes_to_process = [index for index, key in enumerate(keys) if key is None or processed_files.get(key) != current_files.get(key)]
+        old_indexes_to_keep = list()
+        if old_cache is not None:
+            old_indexes_to_keep = [index for index, key in enumerate(old_cache.keys) if key in current_files and processed_files.get(key) == current_files[key]]
+            if len(indexes_to_process) == 0 and len(old_indexes_to_keep) == len(old_cache):
+                return
+            print(f"Updating the FastSpeech dataset in {self.cache_dir}: {len(indexes_to_process)} new or changed datapoints, {len(old_cache) - len(old_indexes_to_keep)} datapoints removed.")
 
-            # build cache
-            print("... building dataset cache ...")
-            self.datapoints = list()
-            self.ctc_losses = list()
+        # build cache
+        print("... building dataset cache ...")
+        self.datapoints = list()
+        self.ctc_losses = list()
+        self.keys = list()
 
+        if len(indexes_to_process) > 0:
             acoustic_model = Aligner()
             acoustic_model.load_state_dict(torch.load(acoustic_checkpoint_path, map_location='cpu')["asr_model"])
+            # without dropout and with the running statistics, an alignment doesn't depend on chance or on the rest of its batch
+            acoustic_model.eval()
 
             # ==========================================
             # actual creation of datapoints starts here
@@ -75,27 +141,41 @@ class FastSpeechDataset(Dataset):
             dio = Dio(reduction_factor=reduction_factor, fs=16000)
             energy_calc = EnergyCalculator(reduction_factor=reduction_factor, fs=16000)
             dc = DurationCalculator(reduction_factor=reduction_factor)
-            vis_dir = os.path.join(cache_dir, "duration_vis")
+            vis_dir = os.path.join(self.cache_dir, "duration_vis")
             os.makedirs(vis_dir, exist_ok=True)
             pros_cond_ext = ProsodicConditionExtractor(sr=16000, device=device)
 
-            for index in tqdm(range(len(dataset))):
-                norm_wave = norm_waves[index]
-                norm_wave_length = torch.LongTensor([len(norm_wave)])
+            wave_lengths = dataset.lengths("wave")
+            indexes = [index for index in indexes_to_process if not (wave_lengths[index] / 16000 < min_len_in_seconds and ctc_selection)]
+            if not save_imgs:
+                print("... aligning ...")
+                durations, ctc_losses = self._align_in_batches(acoustic_model, dataset, indexes, dc, device, aligner_batch_size)
 
-                if len(norm_wave) / 16000 < min_len_in_seconds and ctc_selection:
-                    continue
+            print("... extracting utterance conditions ...")
+            conditions = self._extract_conditions_in_batches(pros_cond_ext, dataset, indexes)
+
+            # pitch extraction only needs the waves, so it runs ahead in a pool while we take care of everything else
+            f0_stream = dio.calculate_f0_stream((dataset.get(index, "wave") for index in indexes), num_workers=pitch_extraction_workers)
 
-                text = dataset[index][0]
-                melspec = dataset[index][2]
-                melspec_length = dataset[index][3]
+            for index in tqdm(indexes):
+                datapoint = dataset[index]
+                norm_wave = datapoint["wave"]
+                norm_wave_length = torch.LongTensor([len(norm_wave)])
+                f0 = next(f0_stream)
 
-                alignment_path, ctc_loss = acoustic_model.inference(mel=melspec.to(device),
-                                                                    tokens=text.to(device),
-                                                                    save_img_for_debug=os.path.join(vis_dir, f"{index}.png") if save_imgs else None,
-                                                                    return_ctc=True)
+                text = datapoint["text"]
+                melspec = datapoint["speech"]
+                melspec_length = datapoint["speech_len"]
 
-                cached_duration = dc(torch.LongTensor(alignment_path), vis=None).cpu()
+                if save_imgs:
+                    alignment_path, ctc_loss = acoustic_model.inference(mel=melspec.to(device),
+                                                                        tokens=text.to(device),
+                                                                        save_img_for_debug=os.path.join(vis_dir, f"{index}.png"),
+                                                                        return_ctc=True)
+                    cached_duration = dc(torch.LongTensor(alignment_path), vis=None).cpu()
+                else:
+                    cached_duration = durations[index]
+                    ctc_loss = ctc_losses[index]
 
                 last_vec = None
                 for phoneme_index, vec in enumerate(text):
@@ -122,74 +202,146 @@ class FastSpeechDataset(Dataset):
                                    input_waves_lengths=norm_wave_length,
                                    feats_lengths=melspec_length,
                                    durations=cached_duration.unsqueeze(0),
-                                   durations_lengths=torch.LongTensor([len(cached_duration)]))[0].squeeze(0).cpu()
+                                   durations_lengths=torch.LongTensor([len(cached_duration)]),
+                                   f0s=[f0])[0].squeeze(0).cpu()
 
-                try:
-                    prosodic_condition = pros_cond_ext.extract_condition_from_reference_wave(norm_wave, already_normalized=True).cpu()
-                except RuntimeError:
+                prosodic_condition = conditions[index]
+                if prosodic_condition is None:
                     # if there is an audio without any voiced segments whatsoever we have to skip it.
                     continue
 
-                self.datapoints.append([dataset[index][0],
-                                        dataset[index][1],
-                                        dataset[index][2],
-                                        dataset[index][3],
+                self.datapoints.append([datapoint["text"],
+                                        datapoint["text_len"],
+                                        datapoint["speech"],
+                                        datapoint["speech_len"],
                                         cached_duration.cpu(),
                                         cached_energy,
                                         cached_pitch,
                                         prosodic_condition])
                 self.ctc_losses.append(ctc_loss)
+                self.keys.append(keys[index])
 
             # =============================
             # done with datapoint creation
             # =============================
 
-            if ctc_selection:
-                # now we can filter out some bad datapoints based on the CTC scores we collected
-                mean_ctc = sum(self.ctc_losses) / len(self.ctc_losses)
-                std_dev = statistics.stdev(self.ctc_losses)
-                threshold = mean_ctc + std_dev
-                for index in range(len(self.ctc_losses), 0, -1):
-                    if self.ctc_losses[index - 1] > threshold:
-                        self.datapoints.pop(index - 1)
-                        print(
-                            f"Removing datapoint {index - 1}, because the CTC loss is one standard deviation higher than the mean. \n ctc: {round(self.ctc_losses[index - 1], 4)} vs. mean: {round(mean_ctc, 4)}")
-
-            # save to cache
-            if len(self.datapoints) > 0:
-                torch.save(self.datapoints, os.path.join(cache_dir, "fast_train_cache.pt"))
-            else:
-                import sys
-                print("No datapoints were prepared! Exiting...")
-                sys.exit()
-        else:
-            # just load the datapoints from cache
-            self.datapoints = torch.load(os.path.join(cache_dir, "fast_train_cache.pt"), map_location='cpu')
+        # save to cache, the selection based on the CTC scores happens when the cache is loaded, so it always considers all of the datapoints
+        if len(self.datapoints) + len(old_indexes_to_keep) == 0:
+            import sys
+            print("No datapoints were prepared! Exiting...")
+            sys.exit()
+        with ShardedCacheWriter(self.cache_path, CACHE_FIELDS, metadata={"processed": current_files}) as writer:
+            for index in old_indexes_to_keep:
+                writer.append(old_cache[index], key=old_cache.keys[index])
+            for datapoint, ctc_loss, key in zip(self.datapoints, self.ctc_losses, self.keys):
+                writer.append(to_cache_item(datapoint, ctc_loss), key=key)
+        del self.datapoints
+        del self.ctc_losses
+        del self.keys
 
-        self.cache_dir = cache_dir
-        self.language_id = get_language_id(lang)
-        print(f"Prepared a FastSpeech dataset with {len(self.datapoints)} datapoints in {cache_dir}.")
+    @staticmethod
+    def _extract_conditions_in_batches(pros_cond_ext, dataset, indexes, window_size=256):
+        """
+        Computes the utterance conditions in padded batches. Only a
+        window of the waves is loaded at a time and the windows are
+        cut from the waves sorted by length, so the batches within
+        them need little padding.
+        """
+        conditions = dict()
+        wave_lengths = dataset.lengths("wave")
+        indexes_by_length = sorted(indexes, key=lambda index: wave_lengths[index])
+        start_time = time.time()
+        for window_start in tqdm(range(0, len(indexes_by_length), window_size)):
+            window = indexes_by_length[window_start:window_start + window_size]
+            conditions.update(zip(window, pros_cond_ext.extract_conditions_from_reference_waves([dataset.get(index, "wave") for index in window],
+                                                                                                already_normalized=True,
+                                                                                                verbose=False)))
+        if len(indexes) > 0:
+            duration = time.time() - start_time
+            print(f"Extracted {len(indexes)} utterance conditions in {round(duration, 2)} seconds "
+                  f"({round(len(indexes) / duration, 2)} per second, {round(sum(wave_lengths[index] for index in indexes) / 16000 / duration, 2)} seconds of audio per second).")
+        return conditions
+
+    @staticmethod
+    def _select_by_ctc(cache, ctc_selection):
+        """
+        Indexes of the datapoints in the cache that are used, which
+        are all of them except for the ones with a CTC loss of more
+        than one standard deviation above the mean, if selected.
+        Datapoints without a known CTC loss are always used.
+        """
+        indexes = np.arange(len(cache))
+        if not ctc_selection:
+            return indexes
+        ctc_losses = cache.values("ctc_loss")
+        known_ctc_losses = ctc_losses[~np.isnan(ctc_losses)].tolist()
+        if len(known_ctc_losses) < 2:
+            return indexes
+        mean_ctc = sum(known_ctc_losses) / len(known_ctc_losses)
+        threshold = mean_ctc + statistics.stdev(known_ctc_losses)
+        selected = ~(ctc_losses > threshold)
+        if not selected.all():
+            print(f"Removing {int((~selected).sum())} datapoints, because their CTC loss is one standard deviation higher than the mean of {round(mean_ctc, 4)}.")
+        return indexes[selected]
+
+    @staticmethod
+    def _align_in_batches(acoustic_model, dataset, indexes, dc, device, batch_size):
+        """
+        Runs the aligner over padded batches of similar length and
+        turns the resulting alignments into durations right away,
+        so the alignment matrices don't have to be kept around.
+        """
+        durations = dict()
+        ctc_losses = dict()
+        mel_lengths = dataset.lengths("speech")
+        indexes_by_length = sorted(indexes, key=lambda index: mel_lengths[index])
+        for batch_start in tqdm(range(0, len(indexes_by_length), batch_size)):
+            batch_indexes = indexes_by_length[batch_start:batch_start + batch_size]
+            mels = pad_sequence([dataset.get(index, "speech") for index in batch_indexes], batch_first=True)
+            mel_lens = torch.LongTensor([mel_lengths[index] for index in batch_indexes])
+            tokens = [dataset.get(index, "tokens") for index in batch_indexes]
+            token_lens = torch.LongTensor([len(token_sequence) for token_sequence in tokens])
+            tokens = pad_sequence(tokens, batch_first=True)
+            alignment_paths, batch_ctc_losses = acoustic_model.batch_inference(mels=mels.to(device),
+                                                                               mel_lens=mel_lens.to(device),
+                                                                               tokens=tokens.to(device),
+                                                                               token_lens=token_lens.to(device))
+            for index, alignment_path, ctc_loss in zip(batch_indexes, alignment_paths, batch_ctc_losses):
+                durations[index] = dc(torch.LongTensor(alignment_path), vis=None).cpu()
+                ctc_losses[index] = ctc_loss
+        return durations, ctc_losses
 
     def __getitem__(self, index):
-        return self.datapoints[index][0], \
-               self.datapoints[index][1], \
-               self.datapoints[index][2], \
-               self.datapoints[index][3], \
-               self.datapoints[index][4], \
-               self.datapoints[index][5], \
-               self.datapoints[index][6], \
-               self.datapoints[index][7], \
+        index = self.indexes[index]
+        return self.cache.get(index, "text", copy=False), \
+               self.cache.get(index, "text_len", copy=False), \
+               self.cache.get(index, "speech", copy=False), \
+               self.cache.get(index, "speech_len", copy=False), \
+               self.cache.get(index, "durations", copy=False), \
+               self.cache.get(index, "energy", copy=False), \
+               self.cache.get(index, "pitch", copy=False), \
+               self.cache.get(index, "utterance_condition", copy=False), \
                self.language_id
 
     def __len__(self):
-        return len(self.datapoints)
+        return len(self.indexes)
 
     def remove_samples(self, list_of_samples_to_remove):
-        for remove_id in sorted(list_of_samples_to_remove, reverse=True):
-            self.datapoints.pop(remove_id)
-        torch.save(self.datapoints, os.path.join(self.cache_dir, "fast_train_cache.pt"))
+        samples_to_remove = {self.indexes[index] for index in list_of_samples_to_remove}
+        # the removed files stay in the list of processed files, so updates don't bring them back
+        with ShardedCacheWriter(self.cache_path, CACHE_FIELDS, metadata=self.cache.metadata) as writer:
+            for index in range(len(self.cache)):
+                if index not in samples_to_remove:
+                    writer.append(self.cache[index], key=self._key(index))
+        self.cache = ShardedCache(self.cache_path)
+        # the remaining datapoints moved forward by the amount of removed datapoints in front of them
+        remaining_indexes = np.delete(self.indexes, list(list_of_samples_to_remove))
+        self.indexes = remaining_indexes - np.searchsorted(sorted(samples_to_remove), remaining_indexes)
         print("Dataset updated!")
 
+    def _key(self, index):
+        return self.cache.keys[index] if self.cache.keys is not None else None
+
     def fix_repeating_phones(self):
         """
         The viterbi decoding of the durations cannot
@@ -197,21 +349,44 @@ class FastSpeechDataset(Dataset):
         but if you have a cache from before March 2022,
         use this method to postprocess those cases.
         """
-        for datapoint_index in tqdm(list(range(len(self.datapoints)))):
-            last_vec = None
-            for phoneme_index, vec in enumerate(self.datapoints[datapoint_index][0]):
-                if last_vec is not None:
-                    if last_vec.numpy().tolist() == vec.numpy().tolist():
-                        # we found a case of repeating phonemes!
-                        # now we must repair their durations by giving the first one 3/5 of their sum and the second one 2/5 (i.e. the rest)
-                        dur_1 = self.datapoints[datapoint_index][4][phoneme_index - 1]
-                        dur_2 = self.datapoints[datapoint_index][4][phoneme_index]
-                        total_dur = dur_1 + dur_2
-                        new_dur_1 = int((total_dur / 5) * 3)
-                        new_dur_2 = total_dur - new_dur_1
-                        self.datapoints[datapoint_index][4][phoneme_index - 1] = new_dur_1
-                        self.datapoints[datapoint_index][4][phoneme_index] = new_dur_2
-                        print("fix applied")
-                last_vec = vec
-        torch.save(self.datapoints, os.path.join(self.cache_dir, "fast_train_cache.pt"))
+        with ShardedCacheWriter(self.cache_path, CACHE_FIELDS, metadata=self.cache.metadata) as writer:
+            for datapoint_index in tqdm(list(range(len(self.cache)))):
+                datapoint = self.cache[datapoint_index]
+                last_vec = None
+                for phoneme_index, vec in enumerate(datapoint["text"]):
+                    if last_vec is not None:
+                        if last_vec.numpy().tolist() == vec.numpy().tolist():
+                            # we found a case of repeating phonemes!
+                            # now we must repair their durations by giving the first one 3/5 of their sum and the second one 2/5 (i.e. the rest)
+                            dur_1 = datapoint["durations"][phoneme_index - 1]
+                            dur_2 = datapoint["durations"][phoneme_index]
+                            total_dur = dur_1 + dur_2
+                            new_dur_1 = int((total_dur / 5) * 3)
+                            new_dur_2 = total_dur - new_dur_1
+                            datapoint["durations"][phoneme_index - 1] = new_dur_1
+                            datapoint["durations"][phoneme_index] = new_dur_2
+                            print("fix applied")
+                    last_vec = vec
+                writer.append(datapoint, key=self._key(datapoint_index))
+        self.cache = ShardedCache(self.cache_path)
         print("Dataset updated!")
+
+
+def to_cache_item(datapoint, ctc_loss):
+    """
+    datapoints hold text, text length, speech, speech length, durations, energy, pitch and utterance condition
+    """
+    item = dict(zip(CACHE_FIELDS, datapoint))
+    item["ctc_loss"] = ctc_loss
+    return item
+
+
+def convert_legacy_cache(cache_dir):
+    """
+    Converts a fast_train_cache.pt from before the sharded format into the sharded format.
+    """
+    print(f"Converting the FastSpeech dataset in {cache_dir} into the sharded format...")
+    with ShardedCacheWriter(os.path.join(cache_dir, "fast_train_cache"), CACHE_FIELDS) as writer:
+        for datapoint in torch.load(os.path.join(cache_dir, "fast_train_cache.pt"), map_location='cpu'):
+            # the CTC selection has already been applied to these, so their loss doesn't matter anymore
+            writer.append(to_cache_item(datapoint, float("nan")))
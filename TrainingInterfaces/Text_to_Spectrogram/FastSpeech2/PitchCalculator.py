@@ -2,12 +2,17 @@
 #  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
 # Adapted by Florian Lux 2021
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pyworld
 import torch
 import torch.nn.functional as F
 from scipy.interpolate import interp1d
 
+from Utility.utils import average_by_duration
 from Utility.utils import pad_list
 
 
@@ -43,13 +48,21 @@ class Dio(torch.nn.Module):
                     reduction_factor=self.reduction_factor)
 
     def forward(self, input_waves, input_waves_lengths=None, feats_lengths=None, durations=None,
-                durations_lengths=None, norm_by_average=True):
+                durations_lengths=None, norm_by_average=True, f0s=None):
+        """
+        f0s can hold the raw F0 contours of the waves if they have already
+        been extracted, e.g. with calculate_f0_stream. They are not
+        recomputed then.
+        """
         # If not provided, we assume that the inputs have the same length
         if input_waves_lengths is None:
             input_waves_lengths = (input_waves.new_ones(input_waves.shape[0], dtype=torch.long) * input_waves.shape[1])
 
         # F0 extraction
-        pitch = [self._calculate_f0(x[:xl]) for x, xl in zip(input_waves, input_waves_lengths)]
+        if f0s is not None:
+            pitch = list(f0s)
+        else:
+            pitch = [self._calculate_f0(x[:xl]) for x, xl in zip(input_waves, input_waves_lengths)]
 
         # (Optional): Adjust length to match with the mel-spectrogram
         if feats_lengths is not None:
@@ -57,13 +70,14 @@ class Dio(torch.nn.Module):
 
         # (Optional): Average by duration to calculate token-wise f0
         if self.use_token_averaged_f0:
-            pitch = [self._average_by_duration(p, d).view(-1) for p, d in zip(pitch, durations)]
+            pitch = self._average_by_duration_batch([p.view(-1) for p in pitch], durations)
             pitch_lengths = durations_lengths
         else:
             pitch_lengths = input_waves.new_tensor([len(p) for p in pitch], dtype=torch.long)
 
         # Padding
-        pitch = pad_list(pitch, 0.0)
+        if isinstance(pitch, list):
+            pitch = pad_list(pitch, 0.0)
 
         # Return with the shape (B, T, 1)
         if norm_by_average:
@@ -71,6 +85,24 @@ class Dio(torch.nn.Module):
             pitch = pitch / average
         return pitch.unsqueeze(-1), pitch_lengths
 
+    def calculate_f0_stream(self, waves, num_workers=4, use_processes=False):
+        """
+        Extracts the raw F0 contours of many waves concurrently
+        and yields them in the same order as the waves come in.
+        Only a limited amount of waves is in flight at any time,
+        so this can be consumed while the waves are still loading.
+        """
+        max_in_flight = 4 * num_workers
+        executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor(max_workers=num_workers) as pool:
+            pending = deque()
+            for wave in waves:
+                pending.append(pool.submit(self._calculate_f0, wave))
+                if len(pending) >= max_in_flight:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+
     def _calculate_f0(self, input):
         x = input.cpu().numpy().astype(np.double)
         f0, timeaxis = pyworld.dio(x, self.fs, f0_floor=self.f0min, f0_ceil=self.f0max, frame_period=self.frame_period)
@@ -113,9 +145,13 @@ class Dio(torch.nn.Module):
         return f0
 
     def _average_by_duration(self, x, d):
-        assert 0 <= len(x) - d.sum() < self.reduction_factor
-        d_cumsum = F.pad(d.cumsum(dim=0), (1, 0))
-        x_avg = [
-            x[start:end].masked_select(x[start:end].gt(0.0)).mean(dim=0) if len(x[start:end].masked_select(x[start:end].gt(0.0))) != 0 else x.new_tensor(0.0)
-            for start, end in zip(d_cumsum[:-1], d_cumsum[1:])]
-        return torch.stack(x_avg)
+        return self._average_by_duration_batch([x], d.unsqueeze(0))[0]
+
+    def _average_by_duration_batch(self, xs, ds):
+        """
+        xs is a list of frame level pitch sequences, ds the padded batch of their durations.
+        Only voiced frames are taken into account.
+        """
+        for x, d in zip(xs, ds):
+            assert 0 <= len(x) - d.sum() < self.reduction_factor
+        return average_by_duration(pad_list(xs, 0.0), ds, only_positive=True)
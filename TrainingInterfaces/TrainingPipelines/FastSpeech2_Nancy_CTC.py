@@ -36,7 +36,7 @@ def run(gpu_id, resume_checkpoint, finetune, model_dir, resume):
     os.makedirs(save_dir_aligner, exist_ok=True)
 
     """
-    if not os.path.exists(os.path.join(cache_dir, "fast_train_cache.pt")):
+    if not ShardedCache.exists(os.path.join(cache_dir, "fast_train_cache")):
         print("Training aligner")
         train_aligner(train_dataset=AlignerDataset(path_to_transcript_dict,
                                                    cache_dir=cache_dir,
@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class KeyValueStore:
+
+    def __init__(self, table, encode, decode, path_to_db=None, max_entries_in_memory=256):
+        """
+        Store with string keys, an in-process LRU in front and
+        optionally an sqlite file on disk behind it, so that the
+        entries survive between runs and can be shared between
+        processes. Safe to use from several threads.
+
+        Args:
+            table: name of the table in the sqlite file, so several stores can share a file
+            encode: turns a value into bytes for the sqlite file
+            decode: turns those bytes back into the value
+            path_to_db: sqlite file, if None the entries only live in memory
+            max_entries_in_memory: size of the LRU
+        """
+        self.table = table
+        self.encode = encode
+        self.decode = decode
+        self.max_entries_in_memory = max_entries_in_memory
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.path_to_db = path_to_db
+        self.version = None
+        self.db = None
+        if path_to_db is not None:
+            if os.path.dirname(path_to_db) != "":
+                os.makedirs(os.path.dirname(path_to_db), exist_ok=True)
+            self.db = sqlite3.connect(path_to_db, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def set_version(self, version):
+        """
+        Drops the entries on disk if they were stored under a different version
+        """
+        with self.lock:
+            if version == self.version:
+                return
+            self.version = version
+            if self.db is None:
+                return
+            row = self.db.execute("SELECT value FROM meta WHERE name = ?", (f"{self.table}_version",)).fetchone()
+            if row is None or row[0] != version:
+                self.db.execute(f"DELETE FROM {self.table}")
+                self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (f"{self.table}_version", version))
+
+    def get(self, key):
+        """
+        Returns the value or None if the key is unknown
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            if self.db is None:
+                return None
+            row = self.db.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value = self.decode(row[0])
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value, overwrite=True):
+        """
+        Without overwrite, a value that is already known for the key is kept
+        """
+        if not overwrite and key in self.memory:
+            return
+        if self.db is not None:
+            with self.lock:
+                cursor = self.db.execute(f"INSERT OR {'REPLACE' if overwrite else 'IGNORE'} INTO {self.table} (key, value) VALUES (?, ?)", (key, self.encode(value)))
+            if cursor.rowcount == 0:
+                # the file already knows a value, which must not be shadowed in memory by the ignored one
+                return
+        self._remember(key, value)
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries_in_memory:
+                self.memory.popitem(last=False)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,194 @@
+"""
+On-disk format for the dataset caches.
+
+A cache is a directory with a manifest.json and a couple of shards.
+For every field of the items, a shard holds one .npy file in which
+that field of all of its items is concatenated along the first axis,
+and one .offsets.npy file that tells where each item starts and ends.
+The manifest can additionally hold a key for every item, e.g. the file
+it was made from, and arbitrary metadata about the cache as a whole.
+The data files are memory-mapped when they are read, so every process
+only pages in the items it actually accesses, and DataLoader workers
+share those pages with each other instead of holding their own copies.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+FORMAT_VERSION = 1
+
+
+class ShardedCacheWriter:
+
+    def __init__(self, path, fields, items_per_shard=1000, metadata=None):
+        """
+        Args:
+            path: directory the cache should be written to. An existing cache there is only replaced once close is called.
+            fields: dict mapping the name of each field to its numpy dtype, e.g. {"speech": "float32"}
+            items_per_shard: amount of items after which a shard is written to disk
+            metadata: json serializable dict that is stored in the manifest
+        """
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.fields = dict(fields)
+        self.items_per_shard = items_per_shard
+        self.metadata = dict() if metadata is None else metadata
+        self.trailing_shapes = dict()
+        self.shards = list()
+        self.buffer = list()
+        self.keys = list()
+        self.num_items = 0
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+    def append(self, item, key=None):
+        """
+        item is a dict with a tensor or numpy array for every field, key is an optional string that identifies it
+        """
+        converted_item = dict()
+        for field in self.fields:
+            value = item[field]
+            if isinstance(value, torch.Tensor):
+                value = value.detach().cpu().numpy()
+            value = np.asarray(value, dtype=self.fields[field])
+            if value.ndim == 0:
+                value = value.reshape(1)
+            if field not in self.trailing_shapes:
+                self.trailing_shapes[field] = list(value.shape[1:])
+            elif list(value.shape[1:]) != self.trailing_shapes[field]:
+                raise ValueError(f"Field {field} has shape {value.shape}, but the previous items had the trailing shape {self.trailing_shapes[field]}.")
+            converted_item[field] = value
+        self.buffer.append(converted_item)
+        self.keys.append(key)
+        self.num_items += 1
+        if len(self.buffer) >= self.items_per_shard:
+            self._write_shard()
+
+    def _write_shard(self):
+        if len(self.buffer) == 0:
+            return
+        shard_name = f"shard_{len(self.shards):05d}"
+        for field in self.fields:
+            values = [item[field] for item in self.buffer]
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in values])
+            np.save(os.path.join(self.tmp_path, f"{shard_name}.{field}.npy"), np.concatenate(values, axis=0))
+            np.save(os.path.join(self.tmp_path, f"{shard_name}.{field}.offsets.npy"), offsets)
+        self.shards.append({"name": shard_name, "num_items": len(self.buffer)})
+        self.buffer = list()
+
+    def close(self):
+        """
+        Writes the last shard and the manifest and moves the cache to its final location
+        """
+        self._write_shard()
+        manifest = {"format_version": FORMAT_VERSION,
+                    "num_items"     : self.num_items,
+                    "fields"        : {field: {"dtype": self.fields[field], "trailing_shape": self.trailing_shapes.get(field, [])} for field in self.fields},
+                    "shards"        : self.shards,
+                    "keys"          : self.keys if any(key is not None for key in self.keys) else None,
+                    "metadata"      : self.metadata}
+        with open(os.path.join(self.tmp_path, "manifest.json"), mode="w", encoding="utf8") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class ShardedCache:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json"), encoding="utf8") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"The cache in {path} has format version {manifest['format_version']}, but version {FORMAT_VERSION} is required.")
+        self.fields = list(manifest["fields"])
+        self.dtypes = {field: manifest["fields"][field]["dtype"] for field in self.fields}
+        self.trailing_shapes = {field: manifest["fields"][field]["trailing_shape"] for field in self.fields}
+        self.shards = [shard["name"] for shard in manifest["shards"]]
+        self.num_items = manifest["num_items"]
+        self.keys = manifest.get("keys")
+        self.metadata = manifest.get("metadata", dict())
+        # the index is kept in a few flat arrays rather than in python objects per item, so
+        # forked worker processes don't touch (and thereby copy) its pages through refcounting
+        self.item_shards = np.repeat(np.arange(len(self.shards), dtype=np.int32), [shard["num_items"] for shard in manifest["shards"]])
+        self.starts = dict()
+        self.ends = dict()
+        for field in self.fields:
+            offsets = [np.load(os.path.join(path, f"{shard}.{field}.offsets.npy")) for shard in self.shards]
+            self.starts[field] = np.concatenate([shard_offsets[:-1] for shard_offsets in offsets]) if len(offsets) > 0 else np.zeros(0, dtype=np.int64)
+            self.ends[field] = np.concatenate([shard_offsets[1:] for shard_offsets in offsets]) if len(offsets) > 0 else np.zeros(0, dtype=np.int64)
+        self.data = None  # memory maps are opened lazily, so they are opened again in every worker process
+
+    @staticmethod
+    def exists(path):
+        """
+        Whether there is a complete cache in the current format at the path
+        """
+        try:
+            with open(os.path.join(path, "manifest.json"), encoding="utf8") as manifest_file:
+                return json.load(manifest_file)["format_version"] == FORMAT_VERSION
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def _open(self):
+        # copy-on-write maps, so that the views we hand out are writable without ever changing the files
+        self.data = {field: [np.load(os.path.join(self.path, f"{shard}.{field}.npy"), mmap_mode="c") for shard in self.shards] for field in self.fields}
+
+    def get(self, index, field, copy=True):
+        """
+        Reads a single field of a single item
+
+        Args:
+            index: index of the item
+            field: name of the field
+            copy: if False, a view into the memory map is returned, which shares its memory with every other process that reads the same item
+        """
+        if self.data is None:
+            self._open()
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index {index} is out of range for a cache with {len(self)} items.")
+        values = self.data[field][self.item_shards[index]][self.starts[field][index]:self.ends[field][index]]
+        return torch.from_numpy(np.array(values) if copy else values)
+
+    def lengths(self, field):
+        """
+        Length along the first axis of the given field for every item, without reading any data
+        """
+        return self.ends[field] - self.starts[field]
+
+    def values(self, field):
+        """
+        All values of a field concatenated along the first axis, e.g. one entry per item for fields that hold a single value per item
+        """
+        if self.data is None:
+            self._open()
+        if len(self.shards) == 0:
+            return np.zeros([0] + self.trailing_shapes[field], dtype=self.dtypes[field])
+        return np.concatenate(self.data[field], axis=0)
+
+    def __getitem__(self, index):
+        return {field: self.get(index, field) for field in self.fields}
+
+    def __len__(self):
+        return self.num_items
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
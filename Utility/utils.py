@@ -2,6 +2,7 @@
 Taken from ESPNet, modified by Florian Lux
 """
 
+import hashlib
 import os
 from abc import ABC
 
@@ -47,6 +48,36 @@ def get_most_recent_checkpoint(checkpoint_dir, verbose=True):
     return os.path.join(checkpoint_dir, "checkpoint_{}.pt".format(checkpoint_list[0]))
 
 
+def hash_file(path, extra=None):
+    """
+    sha1 of the content of a file, optionally together with a string
+    that also influences whatever is derived from the file
+    """
+    file_hash = hashlib.sha1()
+    with open(path, mode="rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            file_hash.update(block)
+    if extra is not None:
+        file_hash.update(b"\x00" + extra.encode("utf8"))
+    return file_hash.hexdigest()
+
+
+def get_fastspeech2_architecture(state_dict):
+    """
+    The arguments that decide which variant of FastSpeech2 a state dict
+    belongs to: the amount of language embeddings (None for single
+    language models) and the size of the utterance embedding (None for
+    single speaker models).
+    """
+    lang_embs = None
+    if "encoder.language_embedding.weight" in state_dict:
+        lang_embs = state_dict["encoder.language_embedding.weight"].shape[0]
+    utt_embed_dim = None
+    if "encoder.embedding_projection.0.weight" in state_dict:
+        utt_embed_dim = state_dict["encoder.embedding_projection.0.weight"].shape[1]
+    return {"lang_embs": lang_embs, "utt_embed_dim": utt_embed_dim}
+
+
 def make_pad_mask(lengths, xs=None, length_dim=-1, device=None):
     """
     Make mask tensor containing indices of padded part.
@@ -114,6 +145,33 @@ def make_non_pad_mask(lengths, xs=None, length_dim=-1, device=None):
     return ~make_pad_mask(lengths, xs, length_dim, device=device)
 
 
+def masked_group_norm(norm, xs, masks):
+    """
+    Applies a GroupNorm module with statistics taken only over the non-padded
+    frames, so that the padding of a batch does not change the result.
+
+    Args:
+        norm (torch.nn.GroupNorm): The module whose groups and affine parameters are used.
+        xs (Tensor): Batch of padded sequences (B, C, Tmax).
+        masks (Tensor): Mask of the non-padded frames (B, 1, Tmax).
+
+    Returns:
+        Tensor: Normalized batch with the padded frames set to zero (B, C, Tmax).
+
+    """
+    batch_size, channels, maxlen = xs.shape
+    masks = masks.to(xs.dtype)
+    grouped = xs.view(batch_size, norm.num_groups, channels // norm.num_groups, maxlen)
+    grouped_masks = masks.view(batch_size, 1, 1, maxlen)
+    count = (grouped_masks.sum(dim=(2, 3), keepdim=True) * grouped.size(2)).clamp(min=1)
+    mean = (grouped * grouped_masks).sum(dim=(2, 3), keepdim=True) / count
+    var = (((grouped - mean) * grouped_masks) ** 2).sum(dim=(2, 3), keepdim=True) / count
+    xs = ((grouped - mean) / torch.sqrt(var + norm.eps)).view(batch_size, channels, maxlen)
+    if norm.affine:
+        xs = xs * norm.weight.view(1, -1, 1) + norm.bias.view(1, -1, 1)
+    return xs * masks
+
+
 def initialize(model, init):
     """
     Initialize weights of a neural network module.
@@ -171,6 +229,33 @@ def pad_list(xs, pad_value):
     return pad
 
 
+def average_by_duration(xs, ds, only_positive=False):
+    """
+    Average frame level values over the frames that belong to each token.
+
+    Args:
+        xs (Tensor): Batch of padded frame level values (B, Tmax).
+        ds (LongTensor): Batch of padded durations (B, Nmax).
+        only_positive (bool): Whether to only average over values > 0, e.g. voiced frames for pitch.
+
+    Returns:
+        Tensor: Batch of token level averages (B, Nmax). Tokens without any frames to average over get 0.
+
+    """
+    batch_size, max_tokens = ds.shape
+    frame_index = torch.arange(xs.size(1), device=ds.device).unsqueeze(0).expand(batch_size, -1).contiguous()
+    # index of the token each frame belongs to, frames after the last token get max_tokens
+    token_of_frame = torch.searchsorted(ds.cumsum(dim=1), frame_index, right=True)
+    valid = token_of_frame < max_tokens
+    if only_positive:
+        valid = valid & xs.gt(0.0)
+    token_of_frame = token_of_frame.clamp(max=max_tokens - 1)
+    valid = valid.to(xs.dtype)
+    sums = xs.new_zeros(batch_size, max_tokens).scatter_add_(1, token_of_frame, xs * valid)
+    counts = xs.new_zeros(batch_size, max_tokens).scatter_add_(1, token_of_frame, valid)
+    return sums / counts.clamp(min=1.0)
+
+
 def subsequent_mask(size, device="cpu", dtype=torch.bool):
     """
     Create mask for subsequent steps (size, size).
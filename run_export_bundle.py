@@ -0,0 +1,32 @@
+import argparse
+import os
+import pathlib
+
+from InferenceInterfaces.InferenceBundle import export_bundle
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Packs a FastSpeech2 model and the HiFiGAN vocoder into a single inference bundle.")
+    parser.add_argument("--model", type=str, help="Name of the FastSpeech2 model, i.e. the part after FastSpeech2_ in the Models directory.", required=False,
+                        default="Cherokee_West")
+    parser.add_argument("--hifigan", type=str, help="Directory of the HiFiGAN model within the Models directory.", required=False, default="HiFiGAN_combined")
+    parser.add_argument("--output", type=str, help="File the bundle is written to.", required=True)
+    parser.add_argument("--torchscript", action="store_true", help="Store the HiFiGAN generator as a traced TorchScript module.")
+    parser.add_argument("--quantize", action="store_true", help="Quantize the linear layers of FastSpeech2 to int8. The bundle can then only run on the cpu.")
+    args = parser.parse_args()
+
+    output_file = os.path.realpath(args.output)
+    # the models are found relative to the code directory
+    os.chdir(pathlib.Path(__file__).resolve().parent)
+    manifest = export_bundle(model_name=args.model,
+                             path_to_bundle=output_file,
+                             hifigan_name=args.hifigan,
+                             torchscript=args.torchscript,
+                             quantize=args.quantize)
+    print(f"Wrote {output_file} ({round(os.path.getsize(output_file) / 1024 / 1024, 1)} MB)")
+    for key, value in manifest.items():
+        print(f" - {key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
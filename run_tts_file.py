@@ -11,18 +11,32 @@ from __future__ import annotations
 
 import argparse
 import dataclasses
+import hashlib
+import json
+import multiprocessing
 import os
 import pathlib
-import shutil
-import tempfile
+import queue
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from datetime import datetime
 
+import numpy as np
 import torch
-from pydub import AudioSegment
 from tqdm import tqdm
 
 from InferenceInterfaces.InferenceFastSpeech2 import InferenceFastSpeech2
+from Preprocessing.ArticulatoryCombinedTextFrontend import get_frontend_version
+from Preprocessing.EmbeddingCache import EmbeddingCache
+from Preprocessing.PhonemeCache import PhonemeCache
+from Utility.utils import hash_file
+
+MODEL_ID: str = "Cherokee_West"
+SAMPLE_RATE: int = 48_000
+TRAILING_SILENCE: int = 24_000  # samples of silence after every entry, as read_to_file adds them
+ENTRIES_PER_TASK: int = 64
+MANIFEST_NAME: str = "tts_manifest.json"
 
 
 @dataclasses.dataclass
@@ -56,6 +70,192 @@ class TTSEntry:
         return entry
 
 
+class OutputManifest:
+    """
+    Remembers for every output file the key of everything it was synthesized from,
+    so that entries whose output is still up to date can be skipped on the next run.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path: pathlib.Path = path
+        self.outputs: dict[str, str] = dict()
+        if path.exists():
+            with open(path, "r", encoding="utf8") as r:
+                self.outputs = json.load(r)["outputs"]
+
+    def _name(self, output: pathlib.Path) -> str:
+        return os.path.relpath(output, self.path.parent)
+
+    def is_current(self, output: pathlib.Path, key: str) -> bool:
+        return output.exists() and self.outputs.get(self._name(output)) == key
+
+    def record(self, output: pathlib.Path, key: str):
+        self.outputs[self._name(output)] = key
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf8") as w:
+            json.dump({"outputs": self.outputs}, w, indent=1, ensure_ascii=False, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def model_hash(my_dir: pathlib.Path) -> str:
+    """
+    Hash of the FastSpeech2 and the HiFiGAN checkpoint, since both decide what the output sounds like.
+    """
+    return hash_file(my_dir.joinpath("Models", f"FastSpeech2_{MODEL_ID}", "best.pt"),
+                     extra=hash_file(my_dir.joinpath("Models", "HiFiGAN_combined", "best.pt")))
+
+
+def entry_key(tts_entry: TTSEntry, ref_voice_hash: str | None, alpha: float, checkpoint_hash: str, frontend_version: str) -> str:
+    """
+    The frontend version is part of the key, since a change to the phones or to espeak changes the output just like a new checkpoint.
+    """
+    key_fields = [tts_entry.lang if tts_entry.lang else "chr", tts_entry.pronunciation, ref_voice_hash, alpha, checkpoint_hash, frontend_version]
+    return hashlib.sha1(json.dumps(key_fields, ensure_ascii=False).encode("utf8")).hexdigest()
+
+
+def load_tts(my_dir: pathlib.Path, alpha: float, device: str) -> InferenceFastSpeech2:
+    """
+    Loads the model with the phoneme and embedding caches of the code directory. Has to run from the code directory.
+    """
+    phoneme_cache = PhonemeCache(path_to_db=os.path.join(my_dir, "Models", "PhonemeCache", "phonemes.sqlite"))
+    embedding_cache = EmbeddingCache(path_to_db=os.path.join(my_dir, "Models", "EmbeddingCache", "embeddings.sqlite"))
+    return InferenceFastSpeech2(device=device, model_name=MODEL_ID, alpha=alpha, phoneme_cache=phoneme_cache, embedding_cache=embedding_cache)
+
+
+def make_tasks(for_processing: list[TTSEntry]) -> list[tuple[str, pathlib.Path | None, list[TTSEntry]]]:
+    """
+    Groups the entries by language and reference voice, so the frontend and the utterance
+    embedding only change between groups, and splits the groups into tasks of a few
+    entries each, so that large groups are still spread over all workers.
+    """
+    groups: dict[tuple[str, pathlib.Path | None], list[TTSEntry]] = dict()
+    for tts_entry in for_processing:
+        groups.setdefault((tts_entry.lang if tts_entry.lang else "chr", tts_entry.ref_voice), list()).append(tts_entry)
+    tasks: list[tuple[str, pathlib.Path | None, list[TTSEntry]]] = list()
+    for (lang, ref_voice), entries in groups.items():
+        for task_start in range(0, len(entries), ENTRIES_PER_TASK):
+            tasks.append((lang, ref_voice, entries[task_start:task_start + ENTRIES_PER_TASK]))
+    return tasks
+
+
+def synthesize_task(tts: InferenceFastSpeech2, default_utterance_embedding: torch.Tensor, state: dict, task, batch_size: int):
+    """
+    Yields every entry of the task together with its wave as a numpy array, including the trailing silence.
+    state remembers the language and voice the model is currently set to.
+    """
+    lang, ref_voice, entries = task
+    if state.get("lang") != lang:
+        tts.set_language(lang)
+        state["lang"] = lang
+    if "ref_voice" not in state or state["ref_voice"] != ref_voice:
+        if ref_voice:
+            tts.set_utterance_embedding(ref_voice)
+        else:
+            tts.default_utterance_embedding = default_utterance_embedding
+        state["ref_voice"] = ref_voice
+    silence = np.zeros(TRAILING_SILENCE, dtype=np.float32)
+    for batch_start in range(0, len(entries), batch_size):
+        batch = entries[batch_start:batch_start + batch_size]
+        waves = tts.synthesize_batch([tts_entry.pronunciation for tts_entry in batch])
+        for tts_entry, wave in zip(batch, waves):
+            yield tts_entry, np.concatenate([wave.cpu().numpy(), silence])
+
+
+def synthesize_in_process(tasks, my_dir: pathlib.Path, alpha: float, device: str, batch_size: int):
+    tts = load_tts(my_dir, alpha, device)
+    default_utterance_embedding = tts.default_utterance_embedding
+    state: dict = dict()
+    for task in tasks:
+        yield from synthesize_task(tts, default_utterance_embedding, state, task, batch_size)
+
+
+def synthesis_worker(task_queue, result_queue, my_dir: pathlib.Path, alpha: float, device: str, batch_size: int):
+    try:
+        os.chdir(my_dir)
+        tts = load_tts(my_dir, alpha, device)
+        default_utterance_embedding = tts.default_utterance_embedding
+        state: dict = dict()
+        for task in iter(task_queue.get, None):
+            result_queue.put(list(synthesize_task(tts, default_utterance_embedding, state, task, batch_size)))
+    finally:
+        # always sign off, otherwise the main process would wait for this worker forever
+        result_queue.put(None)
+
+
+def synthesize_in_workers(tasks, workers: int, my_dir: pathlib.Path, alpha: float, device: str, batch_size: int):
+    """
+    Spreads the tasks over worker processes that each hold their own copy of the model.
+    If a worker dies, the others are stopped and an error is raised, since its entries
+    would otherwise never arrive.
+    """
+    # spawned rather than forked, so that the workers can use cuda
+    context = multiprocessing.get_context("spawn")
+    workers = max(1, min(workers, len(tasks)))
+    task_queue = context.Queue()
+    result_queue = context.Queue(maxsize=2 * workers)
+    for task in tasks:
+        task_queue.put(task)
+    for _ in range(workers):
+        task_queue.put(None)
+    process_list = list()
+    try:
+        for _ in range(workers):
+            process_list.append(context.Process(target=synthesis_worker, args=(task_queue, result_queue, my_dir, alpha, device, batch_size), daemon=True))
+            process_list[-1].start()
+        finished_processes = 0
+        while finished_processes < workers:
+            # a worker that is killed (e.g. out of memory) never signs off, so never wait for good
+            if any(process.exitcode not in (None, 0) for process in process_list):
+                raise RuntimeError("A synthesis worker died, see its error above.")
+            try:
+                result = result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if result is None:
+                finished_processes += 1
+                continue
+            yield from result
+        for process in process_list:
+            process.join()
+        if any(process.exitcode != 0 for process in process_list):
+            raise RuntimeError("A synthesis worker failed, see its error above.")
+    finally:
+        for process in process_list:
+            if process.is_alive():
+                process.terminate()
+
+
+def mp3_tags(tts_entry: TTSEntry) -> dict:
+    tags: dict = dict()
+    tags["artist"] = "IMS-Toucan (https://github.com/CherokeeLanguage/IMS-Toucan)"
+    tags["lyrics"] = tts_entry.pronunciation.strip()
+    tags["title"] = tts_entry.pronunciation.strip()
+    tags["genre"] = "Spoken"
+    tags["copyright"] = f"©{date.today().year} Michael Conrad CC-BY"
+    tags["year"] = date.today().year
+    if tts_entry.lang:
+        tags["lang"] = tts_entry.lang
+    else:
+        tags["lang"] = "chr"
+    tags["publisher"] = "Michael Conrad"
+    tags["date"] = str(datetime.utcnow().isoformat(sep="T", timespec="seconds"))
+    return tags
+
+
+def encode_mp3(wave: np.ndarray, output_mp3: pathlib.Path, tags: dict):
+    """
+    Pipes the wave as 16 bit PCM straight into ffmpeg, so nothing but the MP3 itself touches the disk.
+    """
+    pcm: bytes = (np.clip(wave, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+    command: list[str] = ["ffmpeg", "-y", "-loglevel", "error", "-f", "s16le", "-ar", str(SAMPLE_RATE), "-ac", "1", "-i", "pipe:0"]
+    for key, value in tags.items():
+        command.extend(["-metadata", f"{key}={value}"])
+    command.extend(["-f", "mp3", "-qscale:a", "0", "-id3v2_version", "4", str(output_mp3)])
+    subprocess.run(command, input=pcm, check=True)
+
+
 def main():
     parser = argparse.ArgumentParser(description="IMS-Toucan TTS")
     parser.add_argument("--ref_dir", type=str, help="""
@@ -70,6 +270,14 @@ def main():
     parser.add_argument("--alpha", type=float, help="""
     Speech duration multiplier.
      Defaults to 1.3 where 1.0 is normal speed. Effects entire batch.""", required=True, default=1.3)
+    parser.add_argument("--workers", type=int, help="""
+    Amount of processes that synthesize in parallel, each with its own copy of the model.""", required=False, default=1)
+    parser.add_argument("--encoders", type=int, help="""
+    Amount of MP3 encodings that run in parallel to the synthesis.""", required=False, default=2)
+    parser.add_argument("--batch_size", type=int, help="""
+    Amount of entries with the same language and voice that are synthesized together.""", required=False, default=8)
+    parser.add_argument("--force", action="store_true", help="""
+    Synthesize every entry, even if its output is up to date according to the manifest next to the outputs.""")
     args = parser.parse_args()
 
     source_text: pathlib.Path = pathlib.Path(args.text_file)
@@ -112,15 +320,8 @@ def main():
     else:
         alpha = 1.0
 
-    # TTS script needs to run from the TTS code directory for model loading to work.
-    work_dir = os.getcwd()
     my_dir = pathlib.Path(__file__).resolve().parent
-    os.chdir(my_dir)
-    model_id = "Cherokee_West"
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    tts = InferenceFastSpeech2(device=device, model_name=model_id, alpha=alpha)
-    default_utterance_embedding = tts.default_utterance_embedding
-    os.chdir(work_dir)
 
     tts_entry: TTSEntry
 
@@ -130,42 +331,66 @@ def main():
             tts_entry.ref_voice = ref_dir.joinpath(tts_entry.ref_voice)
         tts_entry.output_mp3 = output_dir.joinpath(tts_entry.output_mp3)
 
+    # every output has a single slot in the manifest, and entries writing to the same file would overwrite each other anyway
+    output_counts: dict[pathlib.Path, int] = dict()
+    for tts_entry in for_processing:
+        output_counts[tts_entry.output_mp3] = output_counts.get(tts_entry.output_mp3, 0) + 1
+    duplicate_outputs: list[str] = [str(output_mp3) for output_mp3, count in output_counts.items() if count > 1]
+    if duplicate_outputs:
+        raise RuntimeError(f"Several entries of {source_text} write to the same output file: {', '.join(duplicate_outputs)}.")
+
+    # Skip whatever was already synthesized from the exact same inputs
+    manifest = OutputManifest(output_dir.joinpath(MANIFEST_NAME))
+    checkpoint_hash: str = model_hash(my_dir)
+    frontend_version: str = get_frontend_version()
+    ref_voice_hashes: dict[pathlib.Path, str] = dict()
+    entry_keys: dict[pathlib.Path, str] = dict()
+    for tts_entry in for_processing:
+        ref_voice_hash: str | None = None
+        if tts_entry.ref_voice:
+            if tts_entry.ref_voice not in ref_voice_hashes:
+                ref_voice_hashes[tts_entry.ref_voice] = hash_file(tts_entry.ref_voice)
+            ref_voice_hash = ref_voice_hashes[tts_entry.ref_voice]
+        entry_keys[tts_entry.output_mp3] = entry_key(tts_entry, ref_voice_hash, alpha, checkpoint_hash, frontend_version)
+    if not args.force:
+        total_entries: int = len(for_processing)
+        for_processing = [tts_entry for tts_entry in for_processing if not manifest.is_current(tts_entry.output_mp3, entry_keys[tts_entry.output_mp3])]
+        if len(for_processing) < total_entries:
+            print(f"Skipping {total_entries - len(for_processing):,} entries that are up to date.")
+        if not for_processing:
+            return
+
+    # TTS script needs to run from the TTS code directory for model loading to work, all other paths are absolute from here on.
+    os.chdir(my_dir)
+
     # Process
     print(f"Batch processing {len(for_processing):,} entries.")
-    prev_voice: pathlib.Path | None = None
-    for tts_entry in tqdm(for_processing):
-        if tts_entry.lang:
-            tts.set_language(tts_entry.lang)
-        else:
-            tts.set_language("chr")  # Assume CHR if not specified.
-        if tts_entry.ref_voice:
-            if tts_entry.ref_voice != prev_voice:
-                os.chdir(my_dir)
-                tts.set_utterance_embedding(tts_entry.ref_voice)
-                os.chdir(work_dir)
-                prev_voice = tts_entry.ref_voice
-        else:
-            tts.default_utterance_embedding = default_utterance_embedding
-            prev_voice = None
-        tmp_dir: str = tempfile.mkdtemp(prefix="tts-ims-toucan-")
-        tmp_wav: str = os.path.join(tmp_dir, "temp.wav")
-        tts.read_to_file([tts_entry.pronunciation], tmp_wav, silent=True)
-        audio: AudioSegment = AudioSegment.from_file(tmp_wav).set_channels(1).set_frame_rate(48_000)
-        tags: dict = dict()
-        tags["artist"] = "IMS-Toucan (https://github.com/CherokeeLanguage/IMS-Toucan)"
-        tags["lyrics"] = tts_entry.pronunciation.strip()
-        tags["title"] = tts_entry.pronunciation.strip()
-        tags["genre"] = "Spoken"
-        tags["copyright"] = f"©{date.today().year} Michael Conrad CC-BY"
-        tags["year"] = date.today().year
-        if tts_entry.lang:
-            tags["lang"] = tts_entry.lang
-        else:
-            tags["lang"] = "chr"
-        tags["publisher"] = "Michael Conrad"
-        tags["date"] = str(datetime.utcnow().isoformat(sep="T", timespec="seconds"))
-        audio.export(tts_entry.output_mp3, format="mp3", parameters=["-qscale:a", "0"], tags=tags)
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+    tasks = make_tasks(for_processing)
+    if args.workers > 1:
+        synthesized = synthesize_in_workers(tasks, args.workers, my_dir, alpha, device, args.batch_size)
+    else:
+        synthesized = synthesize_in_process(tasks, my_dir, alpha, device, args.batch_size)
+    encoders: int = max(1, args.encoders)
+    pending: list = list()
+
+    def finish_oldest():
+        future, finished_entry = pending.pop(0)
+        future.result()
+        manifest.record(finished_entry.output_mp3, entry_keys[finished_entry.output_mp3])
+        progress_bar.update(1)
+
+    try:
+        with ThreadPoolExecutor(max_workers=encoders) as encoder_pool, tqdm(total=len(for_processing)) as progress_bar:
+            for tts_entry, wave in synthesized:
+                pending.append((encoder_pool.submit(encode_mp3, wave, tts_entry.output_mp3, mp3_tags(tts_entry)), tts_entry))
+                # don't let finished waves pile up in memory if the encoders can't keep up
+                while len(pending) > 4 * encoders:
+                    finish_oldest()
+            while pending:
+                finish_oldest()
+    finally:
+        # whatever was finished is remembered, even if the run is interrupted
+        manifest.save()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,404 @@
+"""
+HTTP synthesis server, so that several applications can share the
+loaded models instead of each loading their own copy.
+
+Endpoints:
+    POST /synthesize   JSON body {"text": ..., "lang": "chr", "voice": "<file in --ref_dir>",
+                       "format": "wav" | "pcm", "stream": false, "input_is_phones": false}.
+                       Answers with a 48kHz mono 16 bit WAV file or raw little endian PCM.
+                       With "stream" the PCM is sent in chunks as soon as they are vocoded.
+    GET  /health       JSON with the loaded languages.
+    GET  /metrics      Counters in the Prometheus text format.
+
+A single copy of the multilingual model serves all languages, only the
+text frontend and the language ID are kept per language. Requests for
+the same language and voice that arrive within --max_wait_ms of each
+other are synthesized together in one batch. The padding of a batch is
+masked in FastSpeech2 and in the vocoder, so the audio of a request does
+not depend on which other requests it was batched with. Streamed
+requests are not batched, since they are about getting the first audio
+out quickly.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import dataclasses
+import io
+import json
+import os
+import pathlib
+import time
+import traceback
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+import torch
+
+from InferenceInterfaces.InferenceFastSpeech2 import InferenceFastSpeech2
+from Preprocessing.EmbeddingCache import EmbeddingCache
+from Preprocessing.PhonemeCache import PhonemeCache
+
+SAMPLE_RATE: int = 48_000
+MAX_BODY_SIZE: int = 1 << 20
+STATUS_TEXTS: dict[int, str] = {200: "OK",
+                                400: "Bad Request",
+                                404: "Not Found",
+                                405: "Method Not Allowed",
+                                413: "Payload Too Large",
+                                500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status: int = status
+        self.message: str = message
+
+
+@dataclasses.dataclass
+class SynthesisRequest:
+    text: str
+    lang: str
+    voice: str | None
+    input_is_phones: bool
+    future: asyncio.Future
+
+
+class Metrics:
+
+    def __init__(self):
+        self.counters: dict[str, float] = {"tts_requests_total"                 : 0,
+                                           "tts_request_errors_total"           : 0,
+                                           "tts_batches_total"                  : 0,
+                                           "tts_batched_requests_total"         : 0,
+                                           "tts_streamed_requests_total"        : 0,
+                                           "tts_synthesized_audio_seconds_total": 0.0,
+                                           "tts_synthesis_seconds_total"        : 0.0}
+        self.started: float = time.time()
+
+    def add(self, name: str, value: float = 1):
+        self.counters[name] += value
+
+    def render(self, model: SharedModel) -> str:
+        lines = [f"{name} {value}" for name, value in self.counters.items()]
+        lines.append(f"tts_uptime_seconds {round(time.time() - self.started, 3)}")
+        lines.append(f"tts_queue_depth {model.queue.qsize()}")
+        return "\n".join(lines) + "\n"
+
+
+class SharedModel:
+
+    def __init__(self, tts: InferenceFastSpeech2, languages: list[str], ref_dir: pathlib.Path | None, max_batch_size: int, max_wait: float, metrics: Metrics):
+        """
+        The one loaded model that serves every language. Only the text
+        frontend and the language ID are kept per language and swapped
+        in before a batch. All work on the model happens on its own
+        thread, requests are collected into micro batches by
+        run_batches and the utterance embeddings of the voices are kept
+        once they have been computed (or found in the embedding cache).
+        """
+        self.tts: InferenceFastSpeech2 = tts
+        self.ref_dir: pathlib.Path | None = ref_dir
+        self.max_batch_size: int = max_batch_size
+        self.max_wait: float = max_wait
+        self.metrics: Metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue: asyncio.Queue = asyncio.Queue()  # has to be created within the running event loop
+        self.embeddings: dict[str | None, torch.Tensor] = {None: tts.default_utterance_embedding}
+        self.languages: dict[str, tuple] = dict()
+        for lang in languages:
+            tts.set_language(lang)
+            self.languages[lang] = (tts.text2phone, tts.lang_id)
+
+    def _use(self, lang: str, voice: str | None):
+        self.tts.text2phone, self.tts.lang_id = self.languages[lang]
+        if voice not in self.embeddings:
+            self.tts.set_utterance_embedding(self.ref_dir.joinpath(voice))
+            self.embeddings[voice] = self.tts.default_utterance_embedding
+        self.tts.default_utterance_embedding = self.embeddings[voice]
+
+    def _synthesize_batch(self, lang: str, voice: str | None, texts: list[str], input_is_phones: bool) -> list[np.ndarray]:
+        self._use(lang, voice)
+        return [wave_data.cpu().numpy() for wave_data in self.tts.synthesize_batch(texts, input_is_phones=input_is_phones)]
+
+    def _start_stream(self, lang: str, voice: str | None, text: str, input_is_phones: bool):
+        # the spectrogram is made with the first block, after that the stream no longer depends on the language or the voice
+        self._use(lang, voice)
+        blocks = self.tts.stream(text, input_is_phones=input_is_phones)
+        return blocks, self._next_block(blocks)
+
+    @staticmethod
+    def _next_block(blocks) -> np.ndarray | None:
+        block = next(blocks, None)
+        return None if block is None else block.cpu().numpy()
+
+    async def synthesize(self, text: str, lang: str, voice: str | None, input_is_phones: bool) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(SynthesisRequest(text=text, lang=lang, voice=voice, input_is_phones=input_is_phones, future=future))
+        return await future
+
+    async def stream(self, text: str, lang: str, voice: str | None, input_is_phones: bool):
+        loop = asyncio.get_running_loop()
+        blocks, block = await loop.run_in_executor(self.executor, self._start_stream, lang, voice, text, input_is_phones)
+        while block is not None:
+            yield block
+            block = await loop.run_in_executor(self.executor, self._next_block, blocks)
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: list[SynthesisRequest] = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # one batch can only use a single language and utterance embedding
+            groups: dict[tuple[str, str | None, bool], list[SynthesisRequest]] = dict()
+            for request in batch:
+                groups.setdefault((request.lang, request.voice, request.input_is_phones), list()).append(request)
+            for (lang, voice, input_is_phones), requests in groups.items():
+                synthesis_start = time.perf_counter()
+                try:
+                    waves = await loop.run_in_executor(self.executor, self._synthesize_batch, lang, voice, [request.text for request in requests], input_is_phones)
+                except Exception as e:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+                self.metrics.add("tts_batches_total")
+                self.metrics.add("tts_batched_requests_total", len(requests))
+                self.metrics.add("tts_synthesis_seconds_total", time.perf_counter() - synthesis_start)
+                self.metrics.add("tts_synthesized_audio_seconds_total", sum(len(wave_data) for wave_data in waves) / SAMPLE_RATE)
+                for request, wave_data in zip(requests, waves):
+                    if not request.future.done():
+                        request.future.set_result(wave_data)
+
+
+def to_pcm(wave_data: np.ndarray) -> bytes:
+    return (np.clip(wave_data, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+def to_wav(wave_data: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(to_pcm(wave_data))
+    return buffer.getvalue()
+
+
+class SynthesisServer:
+
+    def __init__(self, model: SharedModel, ref_dir: pathlib.Path | None, metrics: Metrics):
+        self.model: SharedModel = model
+        self.ref_dir: pathlib.Path | None = ref_dir
+        self.metrics: Metrics = metrics
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await self.read_request(reader)
+            if request is not None:
+                await self.route(*request, writer)
+        except HTTPError as e:
+            self.metrics.add("tts_request_errors_total")
+            await self.send(writer, e.status, json.dumps({"error": e.message}).encode("utf8"), "application/json")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            traceback.print_exc()
+            self.metrics.add("tts_request_errors_total")
+            try:
+                await self.send(writer, 500, json.dumps({"error": "synthesis failed"}).encode("utf8"), "application/json")
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, bytes] | None:
+        """
+        Returns the method, the path and the body of the request, or None if the client closed the connection without sending one
+        """
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "malformed request line")
+        headers: dict[str, str] = dict()
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            content_length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise HTTPError(400, "malformed content-length")
+        if content_length > MAX_BODY_SIZE:
+            raise HTTPError(413, f"requests can be at most {MAX_BODY_SIZE} bytes")
+        body = await reader.readexactly(content_length) if content_length > 0 else b""
+        return method.upper(), urlsplit(target).path, body
+
+    async def route(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter):
+        if path == "/health":
+            if method != "GET":
+                raise HTTPError(405, "use GET")
+            await self.send(writer, 200, json.dumps({"status": "ok", "languages": sorted(self.model.languages)}).encode("utf8"), "application/json")
+        elif path == "/metrics":
+            if method != "GET":
+                raise HTTPError(405, "use GET")
+            await self.send(writer, 200, self.metrics.render(self.model).encode("utf8"), "text/plain; version=0.0.4")
+        elif path == "/synthesize":
+            if method != "POST":
+                raise HTTPError(405, "use POST")
+            await self.synthesize(body, writer)
+        else:
+            raise HTTPError(404, f"unknown path {path}")
+
+    def resolve_voice(self, voice: str | None) -> str | None:
+        """
+        Voices are the names of files in the reference directory, nothing outside of it can be used
+        """
+        if voice is None:
+            return None
+        if self.ref_dir is None:
+            raise HTTPError(400, "this server has no reference voices")
+        if pathlib.Path(voice).name != voice or not self.ref_dir.joinpath(voice).is_file():
+            raise HTTPError(404, f"unknown voice {voice}")
+        return voice
+
+    async def synthesize(self, body: bytes, writer: asyncio.StreamWriter):
+        try:
+            request = json.loads(body.decode("utf8"))
+        except (UnicodeDecodeError, ValueError):
+            raise HTTPError(400, "the body has to be a JSON object")
+        if not isinstance(request, dict) or not isinstance(request.get("text"), str) or request["text"].strip() == "":
+            raise HTTPError(400, "text is missing")
+        lang = request.get("lang", "chr")
+        if lang not in self.model.languages:
+            raise HTTPError(404, f"unknown language {lang}, available are {', '.join(sorted(self.model.languages))}")
+        output_format = request.get("format", "wav")
+        if output_format not in ("wav", "pcm"):
+            raise HTTPError(400, "format has to be wav or pcm")
+        voice = self.resolve_voice(request.get("voice"))
+        input_is_phones = bool(request.get("input_is_phones", False))
+        self.metrics.add("tts_requests_total")
+        pcm_type = f"audio/L16; rate={SAMPLE_RATE}; channels=1"
+        if request.get("stream", False):
+            # a WAV header needs the length of the audio up front, so streams are always raw PCM
+            self.metrics.add("tts_streamed_requests_total")
+            blocks = self.model.stream(request["text"], lang, voice, input_is_phones)
+            # errors up to the first block still get a proper error response
+            first_block = await blocks.__anext__()
+            writer.write(self.header(200, pcm_type, {"Transfer-Encoding": "chunked"}))
+            try:
+                await self.send_chunk(writer, to_pcm(first_block))
+                async for block in blocks:
+                    await self.send_chunk(writer, to_pcm(block))
+            except ConnectionError:
+                raise
+            except Exception:
+                # the status line is already out, so the only way to tell the client is to end the
+                # connection without the final chunk, which marks the response as incomplete
+                traceback.print_exc()
+                self.metrics.add("tts_request_errors_total")
+                writer.transport.abort()
+                return
+            finally:
+                await blocks.aclose()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return
+        wave_data = await self.model.synthesize(request["text"], lang, voice, input_is_phones)
+        if output_format == "wav":
+            await self.send(writer, 200, to_wav(wave_data), "audio/wav")
+        else:
+            await self.send(writer, 200, to_pcm(wave_data), pcm_type)
+
+    @staticmethod
+    def header(status: int, content_type: str, extra_headers: dict[str, str]) -> bytes:
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXTS[status]}", f"Content-Type: {content_type}", "Connection: close"]
+        lines.extend(f"{name}: {value}" for name, value in extra_headers.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def send(self, writer: asyncio.StreamWriter, status: int, body: bytes, content_type: str):
+        writer.write(self.header(status, content_type, {"Content-Length": str(len(body))}) + body)
+        await writer.drain()
+
+    @staticmethod
+    async def send_chunk(writer: asyncio.StreamWriter, data: bytes):
+        writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+        await writer.drain()
+
+
+async def serve(args, tts: InferenceFastSpeech2, languages: list[str], ref_dir: pathlib.Path | None):
+    metrics = Metrics()
+    model = SharedModel(tts, languages, ref_dir, args.max_batch_size, args.max_wait_ms / 1000, metrics)
+    batcher = asyncio.ensure_future(model.run_batches())
+    server = await asyncio.start_server(SynthesisServer(model, ref_dir, metrics).handle_connection, host=args.host, port=args.port)
+    print(f"Serving {', '.join(sorted(model.languages))} on http://{args.host}:{args.port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IMS-Toucan TTS server")
+    parser.add_argument("--host", type=str, help="Address to listen on.", required=False, default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Port to listen on.", required=False, default=8080)
+    parser.add_argument("--languages", type=str, help="Comma separated languages that are served by the one multilingual model.", required=False, default="chr")
+    parser.add_argument("--model", type=str, help="Name of the FastSpeech2 model, i.e. the part after FastSpeech2_ in the Models directory.", required=False,
+                        default="Cherokee_West")
+    parser.add_argument("--bundle", type=str, help="Load the models from an inference bundle instead of the Models directory.", required=False, default=None)
+    parser.add_argument("--ref_dir", type=str, help="Directory with the reference audios that can be requested as voices.", required=False, default=None)
+    parser.add_argument("--alpha", type=float, help="Speech duration multiplier, 1.0 is normal speed.", required=False, default=1.0)
+    parser.add_argument("--max_batch_size", type=int, help="Most requests that are synthesized together.", required=False, default=8)
+    parser.add_argument("--max_wait_ms", type=float, help="How long a request waits for others to share a batch with.", required=False, default=20.0)
+    args = parser.parse_args()
+
+    ref_dir: pathlib.Path | None = None
+    if args.ref_dir:
+        ref_dir = pathlib.Path(args.ref_dir).resolve()
+        if not ref_dir.is_dir():
+            raise RuntimeError(f"Reference directory {ref_dir} does not exist.")
+    bundle_path: str | None = os.path.realpath(args.bundle) if args.bundle else None
+
+    # the models are found relative to the code directory
+    my_dir = pathlib.Path(__file__).resolve().parent
+    os.chdir(my_dir)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    phoneme_cache = PhonemeCache(path_to_db=os.path.join(my_dir, "Models", "PhonemeCache", "phonemes.sqlite"))
+    embedding_cache = EmbeddingCache(path_to_db=os.path.join(my_dir, "Models", "EmbeddingCache", "embeddings.sqlite"))
+    languages: list[str] = [lang.strip() for lang in args.languages.split(",") if lang.strip()]
+    if not languages:
+        raise RuntimeError("At least one language has to be served.")
+    tts = InferenceFastSpeech2(device=device,
+                               model_name=args.model,
+                               language=languages[0],
+                               alpha=args.alpha,
+                               phoneme_cache=phoneme_cache,
+                               embedding_cache=embedding_cache,
+                               bundle_path=bundle_path)
+    try:
+        asyncio.run(serve(args, tts, languages, ref_dir))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -60,12 +60,7 @@ class UtteranceCloner:
         if on_line_fine_tune:
             # we fine-tune the aligner for a couple steps using SGD. This makes cloning pretty slow, but the results are greatly improved.
             steps = 10
-            tokens = list()  # we need an ID sequence for training rather than a sequence of phonological features
-            for vector in text:
-                for phone in tf.phone_to_vector:
-                    if vector.numpy().tolist() == tf.phone_to_vector[phone]:
-                        tokens.append(tf.phone_to_id[phone])
-            tokens = torch.LongTensor(tokens)
+            tokens = tf.vectors_to_ids(text)  # we need an ID sequence for training rather than a sequence of phonological features
             tokens = tokens.squeeze().to(self.device)
             tokens_len = torch.LongTensor([len(tokens)]).to(self.device)
             mel = melspec.unsqueeze(0).to(self.device)
@@ -8,23 +8,15 @@ import torch
 
 from TrainingInterfaces.Spectrogram_to_Wave.HiFIGAN.HiFiGAN import HiFiGANGenerator
 from TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.FastSpeech2 import FastSpeech2
+from Utility.utils import get_fastspeech2_architecture
 
 
 def load_net_fast(path):
     check_dict = torch.load(path, map_location=torch.device("cpu"))
-    try:
-        net = FastSpeech2()
-        net.load_state_dict(check_dict["model"])
-        return net, check_dict["default_emb"]
-    except RuntimeError:
-        try:
-            net = FastSpeech2(lang_embs=None)
-            net.load_state_dict(check_dict["model"])
-            return net, check_dict["default_emb"]
-        except RuntimeError:
-            net = FastSpeech2(lang_embs=None, utt_embed_dim=None)
-            net.load_state_dict(check_dict["model"])
-            return net, check_dict["default_emb"]
+    architecture = check_dict.get("architecture", get_fastspeech2_architecture(check_dict["model"]))
+    net = FastSpeech2(lang_embs=architecture["lang_embs"], utt_embed_dim=architecture["utt_embed_dim"])
+    net.load_state_dict(check_dict["model"])
+    return net, check_dict["default_emb"]
 
 
 def load_net_hifigan(path):
@@ -88,8 +80,9 @@ def save_model_for_use(model, name="", default_embed=None, dict_name="model"):
         torch.save({dict_name: model.state_dict()}, name)
     else:
         torch.save({
-            dict_name    : model.state_dict(),
-            "default_emb": default_embed
+            dict_name     : model.state_dict(),
+            "default_emb" : default_embed,
+            "architecture": get_fastspeech2_architecture(model.state_dict())
             }, name)
     print("...done!")
 
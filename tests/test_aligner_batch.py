@@ -0,0 +1,25 @@
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner import Aligner
+
+
+def test_batch_matches_single_items_for_unequal_lengths():
+    torch.manual_seed(0)
+    aligner = Aligner(lstm_dim=64, conv_dim=64)
+    # running statistics that are far from zero, so that padding which is not masked shows up
+    for module in aligner.modules():
+        if isinstance(module, torch.nn.BatchNorm1d):
+            module.running_mean.uniform_(-2.0, 2.0)
+    aligner.eval()
+    mels = [torch.randn(length, 80) for length in (70, 41, 12)]
+    tokens = [torch.randint(0, 144, (length,)) for length in (20, 9, 4)]
+    alignments, ctc_losses = aligner.batch_inference(mels=pad_sequence(mels, batch_first=True),
+                                                     mel_lens=torch.LongTensor([len(mel) for mel in mels]),
+                                                     tokens=pad_sequence(tokens, batch_first=True),
+                                                     token_lens=torch.LongTensor([len(token_sequence) for token_sequence in tokens]))
+    for mel, token_sequence, alignment, ctc_loss in zip(mels, tokens, alignments, ctc_losses):
+        single_alignment, single_ctc_loss = aligner.inference(mel=mel, tokens=token_sequence, train=True, return_ctc=True)
+        assert np.array_equal(alignment, single_alignment)
+        assert abs(ctc_loss - single_ctc_loss) < 1e-4
@@ -0,0 +1,28 @@
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from InferenceInterfaces.InferenceArchitectures.InferenceFastSpeech2 import FastSpeech2
+
+
+def test_batch_matches_single_items_for_unequal_lengths():
+    torch.manual_seed(0)
+    model = FastSpeech2(weights=None)
+    texts = [torch.randn(length, 88) for length in (30, 12, 5)]
+    durations = [torch.randint(1, 5, (text.shape[0],)) for text in texts]
+    utterance_embedding = torch.randn(704)
+    lang_id = torch.LongTensor([12])
+    mels, mel_lengths, _, pitch, energy = model.batch_forward(pad_sequence(texts, batch_first=True),
+                                                              torch.LongTensor([text.shape[0] for text in texts]),
+                                                              utterance_embedding=utterance_embedding,
+                                                              lang_ids=lang_id.repeat(len(texts)),
+                                                              durations=pad_sequence(durations, batch_first=True))
+    for index, (text, duration) in enumerate(zip(texts, durations)):
+        single_mel, _, single_pitch, single_energy = model(text,
+                                                           durations=duration,
+                                                           utterance_embedding=utterance_embedding,
+                                                           lang_id=lang_id,
+                                                           return_duration_pitch_energy=True)
+        assert mel_lengths[index] == single_mel.shape[0]
+        assert torch.allclose(mels[index, :mel_lengths[index]], single_mel, atol=1e-4)
+        assert torch.allclose(pitch[index, :text.shape[0]], single_pitch, atol=1e-4)
+        assert torch.allclose(energy[index, :text.shape[0]], single_energy, atol=1e-4)
@@ -0,0 +1,18 @@
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from InferenceInterfaces.InferenceArchitectures.InferenceHiFiGAN import HiFiGANGenerator
+from InferenceInterfaces.InferenceArchitectures.InferenceHiFiGAN import vocode_batch
+
+
+def test_batch_matches_single_items_for_unequal_lengths():
+    torch.manual_seed(0)
+    generator = HiFiGANGenerator().eval()
+    mels = [torch.randn(80, length) for length in (90, 61, 25, 7)]
+    with torch.inference_mode():
+        batch = pad_sequence([mel.transpose(0, 1) for mel in mels], batch_first=True).transpose(1, 2)
+        waves = vocode_batch(generator, batch, torch.LongTensor([mel.shape[1] for mel in mels]))
+        for mel, wave in zip(mels, waves):
+            single_wave = generator(mel)
+            assert wave.shape == single_wave.shape
+            assert torch.allclose(wave, single_wave, atol=1e-5)